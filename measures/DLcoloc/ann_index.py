@@ -0,0 +1,209 @@
+import numpy as np
+import pandas as pd
+from pathlib import Path
+import argparse
+from scoring import normalize_rows
+from feature_store import open_feature_store
+
+
+METRICS = ('correlation', 'cosine')
+INDEX_FNAME = 'ann.csv'
+ARRAYS_FNAME = 'ann.npz'
+N_ITER = 20         # k-means iterations
+N_PROBE = 8         # inverted lists visited per query
+
+
+def spherical_kmeans(x, n_lists, n_iter=N_ITER, seed=0):
+    """Centroids (n_lists, d) of unit rows `x`, clustered by inner product"""
+    rng = np.random.RandomState(seed)
+    centroids = x[rng.choice(len(x), n_lists, replace=False)]
+    for _ in range(n_iter):
+        assignments = np.argmax(x @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, x)
+        empty = ~sums.any(axis=1)
+        sums[empty] = x[rng.choice(len(x), empty.sum(), replace=False)]     # re-seed empty lists
+        centroids = normalize_rows(sums, center=False).astype(x.dtype)
+    return centroids
+
+
+class AnnIndex(object):
+    """Approximate nearest neighbour index over ion image vectors (mu-model embeddings, U-map features).
+
+    An inverted file index: vectors are normalized, centered first for 'correlation', so similarity is an
+    inner product; a spherical k-means quantizer splits them into inverted lists, and a query only scores
+    the vectors of its `n_probe` closest lists. Searches within one dataset are exact.
+    Vectors are keyed by (datasetId, ion). `add` appends and replaces, `remove` drops keys,
+    `train` re-clusters all vectors, e.g. after many additions.
+    """
+
+    def __init__(self, metric='correlation', n_lists=None, n_probe=N_PROBE, seed=0):
+        if metric not in METRICS:
+            raise ValueError(f'Unknown metric {metric}, choose one of {METRICS}')
+        self.metric = metric
+        self.n_lists = n_lists
+        self.n_probe = n_probe
+        self.seed = seed
+        self.keys = pd.DataFrame(columns=['datasetId', 'ion'])
+        self.vectors = None
+        self.centroids = None
+        self.assignments = np.zeros(0, dtype=np.intp)
+        self._lists = None
+        self._offsets = None
+
+    def __len__(self):
+        return len(self.keys)
+
+    def _normalize(self, vectors):
+        return normalize_rows(vectors, center=self.metric == 'correlation').astype(np.float32)
+
+    def _rows(self, datasetIds, ions):
+        if self._offsets is None:
+            self._offsets = {key: i for i, key in enumerate(zip(self.keys['datasetId'], self.keys['ion']))}
+        return np.array([self._offsets.get(key, -1) for key in zip(datasetIds, ions)], dtype=np.intp)
+
+    def train(self):
+        if len(self) == 0:
+            # nothing to cluster, the next `add` trains again
+            self.centroids = None
+            self.assignments = np.zeros(0, dtype=np.intp)
+            self._lists = None
+            return
+        n_lists = self.n_lists or max(1, int(np.sqrt(len(self))))
+        self.centroids = spherical_kmeans(self.vectors, min(n_lists, len(self)), seed=self.seed)
+        self.assignments = np.argmax(self.vectors @ self.centroids.T, axis=1)
+        self._lists = None
+
+    def add(self, datasetIds, ions, vectors):
+        """Add vectors, replacing those of keys already in the index"""
+        if self.vectors is not None and np.shape(vectors)[1] != self.vectors.shape[1]:
+            raise ValueError(f'Cannot add {np.shape(vectors)[1]}-d vectors to an index of '
+                             f'{self.vectors.shape[1]}-d vectors, vectors of one space go into one index')
+        rows = self._rows(datasetIds, ions)
+        if (rows >= 0).any():
+            self.remove(np.asarray(datasetIds)[rows >= 0], np.asarray(ions)[rows >= 0])
+        vectors = self._normalize(vectors)
+        keys = pd.DataFrame({'datasetId': np.asarray(datasetIds), 'ion': np.asarray(ions)})
+        self.keys = pd.concat([self.keys, keys], ignore_index=True)
+        self._offsets = None
+        self.vectors = vectors if self.vectors is None else np.concatenate([self.vectors, vectors])
+        if self.centroids is None:
+            self.train()
+        else:
+            self.assignments = np.concatenate([self.assignments, np.argmax(vectors @ self.centroids.T, axis=1)])
+            self._lists = None
+
+    def remove(self, datasetIds, ions):
+        rows = self._rows(datasetIds, ions)
+        keep = np.ones(len(self), dtype=bool)
+        keep[rows[rows >= 0]] = False
+        self.keys = self.keys[keep].reset_index(drop=True)
+        self._offsets = None
+        self.vectors = self.vectors[keep]
+        self.assignments = self.assignments[keep]
+        self._lists = None
+
+    def _get_lists(self):
+        if self._lists is None:
+            order = np.argsort(self.assignments, kind='stable')
+            bounds = np.searchsorted(self.assignments[order], np.arange(len(self.centroids) + 1))
+            self._lists = order, bounds
+        return self._lists
+
+    def _candidates(self, query):
+        if self.centroids is None:
+            return np.zeros(0, dtype=np.intp)
+        order, bounds = self._get_lists()
+        n_probe = min(self.n_probe, len(self.centroids))
+        lists = np.argpartition(-(self.centroids @ query), n_probe - 1)[:n_probe]
+        return np.concatenate([order[bounds[l]: bounds[l + 1]] for l in lists])
+
+    def search(self, vectors, k=10, datasetId=None, exclude=None):
+        """k most similar indexed vectors of each query vector, across all datasets or within `datasetId`.
+        `exclude` are rows never returned, one array per query, e.g. the query itself.
+        Returns a list of DataFrames (datasetId, ion, similarity), most similar first."""
+        queries = self._normalize(np.atleast_2d(vectors))
+        in_dataset = None if datasetId is None else np.flatnonzero(self.keys['datasetId'].values == datasetId)
+        results = []
+        for i, query in enumerate(queries):
+            candidates = self._candidates(query) if in_dataset is None else in_dataset
+            if exclude is not None:
+                candidates = np.setdiff1d(candidates, exclude[i], assume_unique=True)
+            similarities = self.vectors[candidates] @ query
+            top = np.argsort(-similarities, kind='stable')[:k]
+            result = self.keys.iloc[candidates[top]].reset_index(drop=True)
+            result['similarity'] = similarities[top]
+            results.append(result)
+        return results
+
+    def query(self, datasetId, ion, k=10, same_dataset=False):
+        """Ions co-localized with an indexed ion, within its dataset or across all datasets"""
+        row = self._rows([datasetId], [ion])[0]
+        if row < 0:
+            raise KeyError((datasetId, ion))
+        return self.search(self.vectors[row], k, datasetId=datasetId if same_dataset else None,
+                           exclude=[np.array([row])])[0]
+
+    def save(self, index_dir):
+        if self.vectors is None:
+            raise ValueError('Nothing to save, no vectors were ever added to the index')
+        index_dir = Path(index_dir)
+        Path.mkdir(index_dir, parents=True, exist_ok=True)
+        if (index_dir / INDEX_FNAME).exists():
+            (index_dir / INDEX_FNAME).unlink()
+        # an untrained, empty index has no centroids
+        centroids = self.centroids if self.centroids is not None else np.zeros((0, self.vectors.shape[1]),
+                                                                              dtype=np.float32)
+        np.savez(index_dir / ARRAYS_FNAME, vectors=self.vectors, centroids=centroids,
+                 assignments=self.assignments, metric=self.metric, n_lists=self.n_lists or 0,
+                 n_probe=self.n_probe, seed=self.seed)
+        # keys are written last, so an interrupted save is never loaded
+        self.keys.to_csv(index_dir / INDEX_FNAME, index=False)
+
+    @staticmethod
+    def load(index_dir):
+        index_dir = Path(index_dir)
+        arrays = np.load(index_dir / ARRAYS_FNAME)
+        index = AnnIndex(str(arrays['metric']), n_lists=int(arrays['n_lists']) or None,
+                         n_probe=int(arrays['n_probe']), seed=int(arrays['seed']))
+        index.keys = pd.read_csv(index_dir / INDEX_FNAME)
+        index.vectors = arrays['vectors']
+        index.centroids = arrays['centroids'] if len(arrays['centroids']) > 0 else None
+        index.assignments = arrays['assignments']
+        return index
+
+
+def load_features(features_path):
+    """(datasetIds, ions, vectors) of the U-map features dumped by train_unsupervised_model.py"""
+    store = open_feature_store(features_path)
+    return store.index['datasetId'].values, store.index['ion'].values, np.asarray(store.features)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('index_dir', help='path to the index, it is created or extended')
+    # U-map features and mu-model embeddings are different spaces, an index holds one of them
+    vectors = parser.add_mutually_exclusive_group()
+    vectors.add_argument('-features', default=None, help='U-map features dumped by train_unsupervised_model.py')
+    vectors.add_argument('-embeddings', nargs=3, default=None, metavar=('EMBD_DIR', 'WEIGHTS', 'CROP_SZ'),
+                         help='mu-model embeddings stored by inference_mu.py')
+    parser.add_argument('-metric', default='correlation', choices=METRICS, help='similarity of a new index')
+    parser.add_argument('-retrain', action='store_true', help='re-cluster all vectors after adding')
+    args = parser.parse_args()
+
+    index_dir = Path(args.index_dir)
+    if not (index_dir / INDEX_FNAME).exists() and args.features is None and args.embeddings is None:
+        parser.error(f'{index_dir} is a new index, pass -features or -embeddings')
+    index = AnnIndex.load(index_dir) if (index_dir / INDEX_FNAME).exists() else AnnIndex(args.metric)
+    if args.features is not None:
+        index.add(*load_features(args.features))
+    if args.embeddings is not None:
+        from embedding_store import EmbeddingStore
+        embd_dir, weights, crop_sz = args.embeddings
+        store = EmbeddingStore(embd_dir, weights, int(crop_sz))
+        index.add(store.index['datasetId'].values, store.index['ion'].values, store.embeddings)
+    if args.retrain:
+        index.train()
+    index.save(index_dir)
+    n_lists = len(index.centroids) if index.centroids is not None else 0
+    print(f'{len(index)} vectors in {n_lists} lists saved to {index_dir}')
@@ -0,0 +1,195 @@
+import sys
+import cv2
+import numpy as np
+import pandas as pd
+from pathlib import Path
+import re
+import argparse
+from scoring import normalize_rows
+
+# pixel measures and their preprocessing are those of the NoLearning notebook
+sys.path.append(str(Path(__file__).resolve().parents[1] / 'NoLearning'))
+import coloc_measures
+
+
+EXT = 'tif'
+BLOCK_SIZE = 1024   # rows of the similarity matrix computed at a time
+BATCH_SIZE = 32
+
+PAIR_MEASURES = ('base', 'pi')
+EMBEDDING_MEASURES = ('mu', 'unsup')
+PIXEL_MEASURES = tuple(coloc_measures.MEASURES)
+MEASURES = PAIR_MEASURES + EMBEDDING_MEASURES + PIXEL_MEASURES
+
+
+def load_images(image_dir):
+    """Ion images '<name>.tif' of one dataset -> (names, list of uint8 images)"""
+    paths = sorted(Path(image_dir).glob(f'*.{EXT}'))
+    return [p.stem for p in paths], [cv2.imread(str(p), cv2.IMREAD_GRAYSCALE) for p in paths]
+
+
+def resize_stack(images, crop_sz):
+    """uint8 stack of the images resized to crop_sz x crop_sz, as they are without crop_sz"""
+    if crop_sz is None:
+        return np.stack([np.asarray(img, dtype=np.uint8) for img in images])
+    return np.stack([cv2.resize(np.asarray(img, dtype=np.uint8), dsize=(crop_sz, crop_sz),
+                                interpolation=cv2.INTER_CUBIC) for img in images])
+
+
+class ColocScorer(object):
+    """Co-localization of all ion pairs of one dataset, as a similarity matrix or top-k neighbours.
+
+    measure:
+        'base', 'pi': pair models (xception), batched inference over all ordered pairs,
+            similarity = 1 - predicted rank / 10
+        'mu': mu-model embeddings, one forward pass per image, similarity = Pearson r of embeddings
+        'unsup': U-map features of the trained unsupervised model, images are embedded into the fitted
+            spaces of the U-map ensemble saved by train_unsupervised_model.py,
+            similarity = Pearson r averaged over the U-map runs
+        'cosine', 'tfidf_cosine', 'pearson', 'spearman', 'ssim': pixel intensity measures of the NoLearning
+            notebook (coloc_measures.py) on the images preprocessed as there, `pixel_params` of
+            `preprocess_stack` or its defaults
+    weights: checkpoint path(s) of the model measures, several checkpoints (e.g. folds) are ensembled;
+        the U-map ensemble directory for 'unsup'.
+        Crop size and embedding size are parsed from checkpoint names unless given.
+    Similarities of embedding measures are matrix products of normalized features, computed `block_size` rows
+    at a time, so `top_k` never holds the full matrix. `processes` of U-map transform and ssim.
+    """
+
+    def __init__(self, measure, weights=(), crop_sz=None, embd_dim=None, batch_size=BATCH_SIZE,
+                 block_size=BLOCK_SIZE, processes=None, pixel_params=None):
+        if measure not in MEASURES:
+            raise ValueError(f'Unknown measure {measure}, choose one of {MEASURES}')
+        self.measure = measure
+        self.weights = [weights] if isinstance(weights, (str, Path)) else list(weights)
+        self.batch_size = batch_size
+        self.block_size = block_size
+        self.processes = processes
+        self.pixel_params = dict(pixel_params or {})
+        self.engine = None
+        self.ensemble = None
+        if measure in PAIR_MEASURES + EMBEDDING_MEASURES and not self.weights:
+            raise ValueError(f'Measure {measure} needs model weights')
+        if measure in PAIR_MEASURES + ('mu',):
+            name = Path(self.weights[0]).name
+            self.crop_sz = crop_sz or int(re.search(r'\.sz([0-9]+)\.', name)[1])
+            if measure == 'mu':
+                self.embd_dim = embd_dim or int(re.search(r'\.embd([0-9]+)\.', name)[1])
+        elif measure == 'unsup':
+            from umap_ensemble import UmapEnsemble
+            self.ensemble = UmapEnsemble.load(self.weights[0])
+            self.crop_sz = crop_sz or self.ensemble.params.get('crop_sz')
+        else:
+            self.crop_sz = crop_sz
+
+    def _get_engine(self):
+        if self.engine is None:
+            from inference_engine import InferenceEngine
+            from models import xception, mu_model
+            if self.measure == 'mu':
+                self.engine = InferenceEngine(mu_model, embd_dim=self.embd_dim, return_core_model=True)
+            else:
+                self.engine = InferenceEngine(xception)
+            for weights_path in self.weights:
+                self.engine.add(str(weights_path), weights_path)
+        return self.engine
+
+    def features(self, images):
+        """Normalized features, one (n_images, n_features) array per model or U-map run,
+        similarities are their row products"""
+        if self.measure == 'mu':
+            from datagen import model_input
+            from model_utils import predict_stream
+            engine = self._get_engine()
+            x = resize_stack(images, self.crop_sz)
+            features = []
+            for key in engine.fold_weights:
+                batches = (model_input(x[i: i + self.batch_size, ..., None]) for i in range(0, len(x), self.batch_size))
+                features.append(normalize_rows(predict_stream(engine.use(key), batches)))
+            return features
+
+        if self.measure == 'unsup':
+            x = resize_stack(images, self.crop_sz).reshape(len(images), -1)
+            return [normalize_rows(embedding)
+                    for embedding in self.ensemble.transform(x, processes=self.processes, verbose=False)]
+
+        raise ValueError(f'Measure {self.measure} has no features')
+
+    def _pair_blocks(self, images):
+        from datagen import model_input
+        engine = self._get_engine()
+        x = resize_stack(images, self.crop_sz)
+        n = len(x)
+        for start in range(0, n, self.block_size):
+            stop = min(start + self.block_size, n)
+            base, other = np.divmod(np.arange(start * n, stop * n), n)
+
+            def batches():
+                for i in range(0, len(base), self.batch_size):
+                    yield model_input(np.stack([x[base[i: i + self.batch_size]], x[other[i: i + self.batch_size]]],
+                                               axis=-1))
+
+            y_pred = engine.predict_ensemble(batches())
+            yield start, stop, 1 - y_pred.reshape(stop - start, n)
+
+    def blocks(self, images):
+        """Yields (start, stop, similarity[start: stop])"""
+        if self.measure in PAIR_MEASURES:
+            yield from self._pair_blocks(images)
+            return
+        if self.measure in PIXEL_MEASURES:
+            x = coloc_measures.preprocess_stack(np.stack(images).astype(np.float32), inplace=True,
+                                                **self.pixel_params)
+            sim = coloc_measures.similarities(x, [self.measure], processes=self.processes)[self.measure]
+            for start in range(0, len(sim), self.block_size):
+                yield start, min(start + self.block_size, len(sim)), sim[start: start + self.block_size]
+            return
+        features = self.features(images)
+        n = len(features[0])
+        for start in range(0, n, self.block_size):
+            stop = min(start + self.block_size, n)
+            yield start, stop, np.mean([f[start: stop] @ f.T for f in features], axis=0)
+
+    def score(self, images):
+        """(n_images, n_images) similarity matrix, rows are base ions"""
+        return np.concatenate([sim for _, _, sim in self.blocks(images)])
+
+    def top_k(self, images, k=10):
+        """Indices and similarities of the k most similar other ions of each ion, most similar first"""
+        n = len(images)
+        k = min(k, n - 1)
+        indices = np.zeros((n, k), dtype=np.intp)
+        similarities = np.zeros((n, k))
+        if k == 0:
+            return indices, similarities
+        for start, stop, sim in self.blocks(images):
+            sim = np.nan_to_num(sim, nan=-np.inf)
+            sim[np.arange(stop - start), np.arange(start, stop)] = -np.inf     # not the ion itself
+            top = np.argpartition(-sim, k - 1, axis=1)[:, :k]
+            top_sim = np.take_along_axis(sim, top, axis=1)
+            order = np.argsort(-top_sim, axis=1, kind='stable')
+            indices[start: stop] = np.take_along_axis(top, order, axis=1)
+            similarities[start: stop] = np.take_along_axis(top_sim, order, axis=1)
+        return indices, similarities
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('image_dir', help='path to ion images of one dataset')
+    parser.add_argument('measure', choices=MEASURES, help='co-localization measure')
+    parser.add_argument('output', help='csv file for the similarity matrix or the top-k neighbours')
+    parser.add_argument('-weights', nargs='+', default=[],
+                        help='model checkpoint(s), several are ensembled; U-map ensemble directory for unsup')
+    parser.add_argument('-top_k', type=int, default=None, help='save top-k neighbours per ion instead of the matrix')
+    parser.add_argument('-processes', type=int, default=None, help='processes of U-map transform and ssim')
+    args = parser.parse_args()
+
+    names, images = load_images(args.image_dir)
+    scorer = ColocScorer(args.measure, weights=args.weights, processes=args.processes)
+    if args.top_k is None:
+        pd.DataFrame(scorer.score(images), index=names, columns=names).to_csv(args.output)
+    else:
+        indices, similarities = scorer.top_k(images, args.top_k)
+        pd.DataFrame({'ion': np.repeat(names, indices.shape[1]),
+                      'other': np.array(names)[indices.ravel()],
+                      'similarity': similarities.ravel()}).to_csv(args.output, index=False)
@@ -2,9 +2,9 @@ import cv2
 import numpy as np
 from pathlib import Path
 import pandas as pd
-import re
 import threading
 from keras import backend as K
+from utils import PairIndex, split_image_names
 from albumentations import (
     HorizontalFlip,
     VerticalFlip,
@@ -20,6 +20,9 @@ from albumentations import (
 )
 
 
+SHRT_MAX = 32767
+
+
 def preprocess(x):
     return x / 255. * 2. - 1.0
 
@@ -80,15 +83,280 @@ def train_transform(p=1.0):
     return transform_fun
 
 
+def _grid_tables(n, num_steps, steps):
+    """Per-sample 1D maps of albumentations' grid distortion, `steps` is (B, num_steps + 1)"""
+    step = n // num_steps
+    table = np.zeros((len(steps), n), np.float32)
+    prev = np.zeros(len(steps))
+    for idx in range(num_steps + 1):
+        start = idx * step
+        end = start + step
+        if end > n:
+            end = n
+            cur = np.full(len(steps), float(n))
+        else:
+            cur = prev + step * steps[:, idx]
+        table[:, start:end] = prev[:, None] + (cur - prev)[:, None] * np.linspace(0, 1, end - start)
+        prev = cur
+    return table
+
+
+def _interp_rows(table, q):
+    """Linear interpolation of per-sample 1D maps `table` (B, n) at points `q` (B, H, W),
+    extrapolated by the edge segments one step beyond [0, n - 1]"""
+    n = table.shape[1]
+    xp = np.arange(-1, n + 1, dtype=np.float32)
+    out = np.empty_like(q)
+    for i, t in enumerate(table):
+        fp = np.concatenate([[2 * t[0] - t[1]], t, [2 * t[-1] - t[-2]]])
+        out[i] = np.interp(q[i], xp, fp)
+    return out
+
+
+def _remap_constant(batch, map_x, map_y):
+    """cv2.remap(..., INTER_LINEAR, BORDER_CONSTANT) of every sample of a (B, H, W, C) `batch` with its own maps.
+
+    Samples are stacked into one tall image with a zero frame around each, so a single remap call serves
+    the whole batch; coordinates that would reach a neighbouring sample are moved outside the image.
+    """
+    b, h, w, c = batch.shape
+    out = np.empty_like(batch)
+    chunk = max(1, SHRT_MAX // (h + 2) - 1)    # remap coordinates are limited to short
+    for i in range(0, b, chunk):
+        n = min(chunk, b - i)
+        framed = np.zeros((n, h + 2, w + 2, c), dtype=batch.dtype)
+        framed[:, 1: -1, 1: -1] = batch[i: i + n]
+        mx = map_x[i: i + n].astype(np.float32) + 1
+        my = map_y[i: i + n].astype(np.float32) + 1
+        outside = ~((mx >= -1) & (mx <= w + 1) & (my >= -1) & (my <= h + 1))
+        mx[outside] = -2
+        my += (np.arange(n, dtype=np.float32) * (h + 2))[:, None, None]
+        out[i: i + n] = cv2.remap(framed.reshape(n * (h + 2), w + 2, c), mx.reshape(n * h, w), my.reshape(n * h, w),
+                                  interpolation=cv2.INTER_LINEAR, borderMode=cv2.BORDER_CONSTANT,
+                                  borderValue=0).reshape(n, h, w, c)
+    return out
+
+
+class BatchTransform(object):
+    """`train_transform` applied to a whole (B, H, W, C) uint8 batch.
+
+    Every sample draws its own parameters, as before, but each stage is a handful of array operations:
+    flips and rot90 are strided views copied straight into the output, channel swaps a reversed view,
+    gamma a per-sample lookup table, and the optical distortion, grid distortion and shift-scale-rotate
+    are composed into one remap grid per sample and sampled once with bilinear interpolation
+    (the per-sample path interpolates three times, so results are close but not bit-equal).
+    With `per_sample=True` the batch goes through `train_transform` sample by sample, for parity tests.
+    """
+
+    def __init__(self, p=1.0, per_sample=False, gamma_limit=(90, 350), distort_limit=0.05,
+                 num_steps=5, grid_distort_limit=0.3, shift_limit=0.0625, scale_limit=0.2, rotate_limit=45):
+        self.p = p
+        self.gamma_limit = gamma_limit
+        self.distort_limit = distort_limit
+        self.num_steps = num_steps
+        self.grid_distort_limit = grid_distort_limit
+        self.shift_limit = shift_limit
+        self.scale_limit = scale_limit
+        self.rotate_limit = rotate_limit
+        self.sample_transform = train_transform(p) if per_sample else None
+
+    def __call__(self, batch):
+        if self.sample_transform is not None:
+            return np.stack([self.sample_transform(img) for img in batch])
+        if len(batch) == 0:
+            return batch
+
+        b, h, w, c = batch.shape
+        rng = np.random
+        applied = rng.rand(b) < self.p     # Compose(p=p)
+
+        def apply(p=self.p):
+            return applied & (rng.rand(b) < p)
+
+        # FlipChannels has the default p=0.5
+        perm = np.where(apply(0.5)[:, None], np.argsort(rng.rand(b, c), axis=1), np.arange(c))
+        vflip = apply()
+        hflip = apply()
+        k = np.where(apply(), rng.randint(4, size=b), 0)
+        batch = self.flip(batch, perm, vflip, hflip, k)
+
+        gamma = np.where(apply(), rng.uniform(*self.gamma_limit, size=b) / 100, 1.)
+        batch = self.gamma(batch, gamma)
+
+        distortion = np.where(apply(), rng.uniform(-self.distort_limit, self.distort_limit, size=b), np.nan)
+        grid = apply()
+        xsteps, ysteps = 1 + rng.uniform(-self.grid_distort_limit, self.grid_distort_limit,
+                                         size=(2, b, self.num_steps + 1))
+        ssr = apply()
+        angle = np.where(ssr, rng.uniform(-self.rotate_limit, self.rotate_limit, size=b), 0.)
+        scale = np.where(ssr, rng.uniform(1 - self.scale_limit, 1 + self.scale_limit, size=b), 1.)
+        dx, dy = np.where(ssr, rng.uniform(-self.shift_limit, self.shift_limit, size=(2, b)), 0.)
+        if not np.isnan(distortion).all() or grid.any() or ssr.any():
+            batch = self.warp(batch, distortion, np.where(grid[:, None], xsteps, np.nan),
+                              np.where(grid[:, None], ysteps, np.nan), angle, scale, dx, dy)
+        return batch
+
+    @staticmethod
+    def flip(batch, perm, vflip, hflip, k):
+        """FlipChannels, VerticalFlip, HorizontalFlip, RandomRotate90 (k times), in this order"""
+        out = np.empty_like(batch)
+        for i, (v, h, r) in enumerate(zip(vflip, hflip, k)):
+            out[i] = np.rot90(batch[i, ::-1 if v else 1, ::-1 if h else 1], r)
+        if batch.shape[-1] == 2:
+            swap = perm[:, 0] == 1
+            out[swap] = out[swap][..., ::-1]
+        elif (perm != np.arange(batch.shape[-1])).any():
+            out = np.take_along_axis(out, perm[:, None, None, :], axis=-1)
+        return out
+
+    @staticmethod
+    def gamma(batch, gamma):
+        """RandomGamma as one lookup table per sample"""
+        tables = ((np.arange(256) / 255.)[None] ** gamma[:, None] * 255).astype(np.uint8)
+        out = batch.copy()
+        for i in np.flatnonzero(gamma != 1):
+            out[i] = cv2.LUT(batch[i], tables[i])
+        return out
+
+    def warp(self, batch, distortion, xsteps, ysteps, angle, scale, dx, dy):
+        """OpticalDistortion, GridDistortion and ShiftScaleRotate with BORDER_CONSTANT, as one remap.
+        `distortion` and `xsteps`/`ysteps` are NaN for samples that skip the optical / grid distortion."""
+        b, h, w, c = batch.shape
+        y, x = np.mgrid[0:h, 0:w].astype(np.float32)
+        grid = np.stack([x.ravel(), y.ravel(), np.ones(h * w, dtype=np.float32)])
+
+        # inverse of cv2.getRotationMatrix2D((w / 2, h / 2), angle, scale) shifted by (dx * w, dy * h),
+        # applied to all output pixels of all samples in one matrix product
+        alpha = scale * np.cos(np.deg2rad(angle))
+        beta = scale * np.sin(np.deg2rad(angle))
+        tx = (1 - alpha) * w / 2 - beta * h / 2 + dx * w
+        ty = beta * w / 2 + (1 - alpha) * h / 2 + dy * h
+        inverse = np.stack([np.stack([alpha, -beta, beta * ty - alpha * tx], axis=-1),
+                            np.stack([beta, alpha, -beta * tx - alpha * ty], axis=-1)], axis=1)
+        inverse /= (scale ** 2)[:, None, None]
+        qx, qy = np.matmul(inverse.astype(np.float32), grid).reshape(b, 2, h, w).transpose(1, 0, 2, 3)
+        inside = (np.abs(qx - (w - 1) / 2) < (w + 1) / 2) & (np.abs(qy - (h - 1) / 2) < (h + 1) / 2)
+
+        # grid distortion maps are separable piecewise linear functions
+        no_grid = np.isnan(xsteps[:, 0])
+        rx, ry = qx, qy
+        if not no_grid.all():
+            xx = _grid_tables(w, self.num_steps, np.nan_to_num(xsteps))
+            yy = _grid_tables(h, self.num_steps, np.nan_to_num(ysteps))
+            xx[no_grid] = np.arange(w)
+            yy[no_grid] = np.arange(h)
+            rx = _interp_rows(xx, qx)
+            ry = _interp_rows(yy, qy)
+
+        # cv2.initUndistortRectifyMap with focal lengths (w, h), distortion (k, k, 0, 0, 0) and the default
+        # new camera matrix, whose principal point is ((w - 1) / 2, (h - 1) / 2) instead of (w / 2, h / 2)
+        k = np.nan_to_num(distortion).astype(np.float32)[:, None, None]
+        no_optical = np.isnan(distortion)[:, None, None]
+        sx = rx - (w - 1) / 2
+        sx /= w
+        sy = ry - (h - 1) / 2
+        sy /= h
+        radial = sx * sx
+        radial += sy * sy
+        radial *= radial + 1
+        radial *= k
+        radial += 1     # 1 + k * r2 + k * r2 ** 2
+        sx *= radial
+        sx *= w
+        sx += np.where(no_optical, (w - 1) / 2, w / 2).astype(np.float32)
+        sy *= radial
+        sy *= h
+        sy += np.where(no_optical, (h - 1) / 2, h / 2).astype(np.float32)
+
+        sx[~inside] = -2
+        return _remap_constant(batch, sx, sy)
+
+
+def train_batch_transform(p=1.0, per_sample=False):
+    return BatchTransform(p=p, per_sample=per_sample)
+
+
+class ImageReader(object):
+    """Reads resized uint8 images by image id, from a packed store when given, else from tif files.
+    `preprocess` is applied to every read stack (..., crop_sz, crop_sz) and may work in place,
+    e.g. `functools.partial(coloc_measures.preprocess_stack, inplace=True)` of the NoLearning measures."""
+
+    def __init__(self, data_dir, datasetIds, ions, crop_sz, store=None, preprocess=None):
+        self.crop_sz = crop_sz
+        self.store = store
+        self.preprocess = preprocess
+        if store is None:
+            self.paths = [str(data_dir / '.'.join((datasetId, ion, 'tif'))) for datasetId, ion in zip(datasetIds, ions)]
+        else:
+            assert store.crop_sz == crop_sz
+            self.rows = store.offsets(datasetIds, ions)
+
+    def read(self, ids):
+        """(len(ids), crop_sz, crop_sz)"""
+        if self.store is not None:
+            images = self.store.images[self.rows[ids]]
+        else:
+            images = np.zeros((len(ids), self.crop_sz, self.crop_sz), dtype=np.uint8)
+            for i, image_id in enumerate(ids):
+                img = cv2.imread(self.paths[image_id], cv2.IMREAD_GRAYSCALE)
+                images[i] = cv2.resize(img, dsize=(self.crop_sz, self.crop_sz), interpolation=cv2.INTER_CUBIC)
+        return images if self.preprocess is None else self.preprocess(images)
+
+    def read_pairs(self, base_ids, other_ids):
+        """(len(base_ids), crop_sz, crop_sz, 2)"""
+        if self.store is not None:
+            images = np.stack([self.store.images[self.rows[base_ids]], self.store.images[self.rows[other_ids]]],
+                              axis=-1)
+        else:
+            images = np.zeros((len(base_ids), self.crop_sz, self.crop_sz, 2), dtype=np.uint8)
+            for i, (base_id, other_id) in enumerate(zip(base_ids, other_ids)):
+                img = np.stack([cv2.imread(self.paths[base_id], cv2.IMREAD_GRAYSCALE),
+                                cv2.imread(self.paths[other_id], cv2.IMREAD_GRAYSCALE)],
+                               axis=-1)
+                images[i] = cv2.resize(img, dsize=(self.crop_sz, self.crop_sz), interpolation=cv2.INTER_CUBIC)
+        if self.preprocess is None:
+            return images
+        # channels as a stack axis: (n, 2, crop_sz, crop_sz)
+        return np.moveaxis(self.preprocess(np.moveaxis(images, -1, 1)), 1, -1)
+
+
+def augment_batch(augment, batch):
+    if augment is None or augment is null_transform:
+        return batch
+    if isinstance(augment, BatchTransform):
+        return augment(batch)
+    return np.stack([augment(img) for img in batch])
+
+
+def model_input(batch, uint8_output=False):
+    """uint8 (B, H, W, C) batch -> model input in K.image_data_format().
+    Preprocessed floats by default; with `uint8_output` the raw uint8 batch as read and augmented,
+    for models built with `input_scaling=True`."""
+    if not uint8_output:
+        batch = preprocess(batch.astype(K.floatx()))
+    if K.image_data_format() == 'channels_first':   # theano format
+        batch = np.moveaxis(batch, -1, 1)
+    return batch
+
+
+def noisy_target(rank, target_noise):
+    noise = np.random.uniform(-target_noise, target_noise, len(rank))
+    return np.clip(rank + noise * 10, 0, 10) / 10
+
+
 class Iterator(object):
     """Iterator for co-localization"""
 
     def __init__(self, data_dir, data_df, crop_sz, augment=null_transform, target_noise=0.0,
                  shuffle=True, seed=None, infinite_loop=True, batch_size=32,
-                 verbose=False, gen_id='', output_fname=False):
+                 verbose=False, gen_id='', output_fname=False, store=None, uint8_output=False,
+                 preprocess=None):
         self.lock = threading.Lock()
         self.data_dir = data_dir
         self.data_df = data_df
+        self.pairs = PairIndex(data_df)
+        self.reader = ImageReader(data_dir, self.pairs.datasetIds, self.pairs.ions, crop_sz, store, preprocess)
+        self.order = np.arange(len(self.pairs))
         self.crop_sz = crop_sz
         self.shuffle = shuffle
         self.seed = seed
@@ -103,9 +371,10 @@ class Iterator(object):
         self.output_fname = output_fname
         self.augment = augment
         self.target_noise = target_noise
+        self.uint8_output = uint8_output
 
     def _flow_index(self):
-        data_len = len(self.data_df)
+        data_len = len(self.pairs)
         while 1:
             if self.seed is None:
                 random_seed = None
@@ -119,7 +388,9 @@ class Iterator(object):
                 if self.verbose:
                     print(f'\n************** New epoch. Generator {self.gen_id} *******************')
                 if self.shuffle:
-                    self.data_df = self.data_df.sample(data_len, random_state=random_seed)
+                    # same permutation as data_df.sample(data_len, random_state=random_seed)
+                    random_state = np.random if random_seed is None else np.random.RandomState(random_seed)
+                    self.order = self.order[random_state.choice(data_len, data_len, replace=False)]
 
             current_index = self.batch_index * self.batch_size
             if data_len > current_index + self.batch_size:
@@ -130,40 +401,24 @@ class Iterator(object):
                 self.batch_index = 0
             self.total_batches_seen += 1
 
-            yield self.data_df.iloc[current_index: current_index + current_batch_size], \
-                  current_index, current_batch_size
+            yield self.order[current_index: current_index + current_batch_size]
 
     def next(self):
         with self.lock:
-            df_slice, current_index, current_batch_size = next(self.index_generator)
-
-        batch_x = np.zeros((current_batch_size, self.crop_sz, self.crop_sz, self.n_channels), dtype=K.floatx())
-        batch_y = np.zeros((current_batch_size, 1), dtype=K.floatx())
-        batch_fname = []
-
-        for i, (df_index, row) in enumerate(df_slice.iterrows()):
-            datasetId, baseSf, baseAdduct, otherSf, otherAdduct, rank = row
-            base_ion = '.'.join((baseSf, baseAdduct.replace('+', 'p').replace('-', 'm')))
-            other_ion = '.'.join((otherSf, otherAdduct.replace('+', 'p').replace('-', 'm')))
-            first_img = str(self.data_dir / '.'.join((datasetId, base_ion, 'tif')))
-            other_img = str(self.data_dir / '.'.join((datasetId, other_ion, 'tif')))
-            img = np.stack([cv2.imread(first_img, cv2.IMREAD_GRAYSCALE),
-                            cv2.imread(other_img, cv2.IMREAD_GRAYSCALE)],
-                            axis=-1)
-            img = cv2.resize(img, dsize=(self.crop_sz, self.crop_sz), interpolation=cv2.INTER_CUBIC)
-            img = self.augment(img)
-            batch_x[i] = img
-            batch_y[i] = np.clip(rank + np.random.uniform(-self.target_noise, self.target_noise) * 10, 0, 10) / 10
-            batch_fname.append((datasetId, base_ion, other_ion))
-
-        batch_x = preprocess(batch_x)
-
-        if K.image_data_format() == 'channels_first':   # theano format
-            batch_x = np.moveaxis(batch_x, -1, 1)
+            index_array = next(self.index_generator)
+        return self._get_batch(index_array)
+
+    def _get_batch(self, index_array):
+        base = self.pairs.base[index_array]
+        other = self.pairs.other[index_array]
+
+        batch_x = augment_batch(self.augment, self.reader.read_pairs(base, other))
+        batch_x = model_input(batch_x, self.uint8_output)
+        batch_y = noisy_target(self.pairs.target[index_array], self.target_noise).astype(K.floatx())[:, None]
 
         result = batch_x, batch_y
         if self.output_fname:
-            result += (batch_fname,)
+            result += (list(zip(self.pairs.datasetIds[base], self.pairs.ions[base], self.pairs.ions[other])),)
         return result
 
     def __iter__(self):
@@ -182,12 +437,20 @@ class IteratorPi(object):
     def __init__(self, sup_data_dir, unsup_data_dir, sup_df, unsup_df, crop_sz,
                  augment=null_transform, target_noise=0.0,
                  shuffle=True, seed=None, infinite_loop=True, batch_size=32,
-                 verbose=False, gen_id='', output_fname=False):
+                 verbose=False, gen_id='', output_fname=False, store=None, uint8_output=False,
+                 preprocess=None):
         self.lock = threading.Lock()
         self.sup_data_dir = sup_data_dir
         self.unsup_data_dir = unsup_data_dir
         self.sup_df = sup_df
         self.unsup_df = unsup_df
+        self.sup_pairs = PairIndex(sup_df)
+        self.unsup_pairs = PairIndex(unsup_df)
+        self.sup_reader = ImageReader(sup_data_dir, self.sup_pairs.datasetIds, self.sup_pairs.ions, crop_sz, store,
+                                      preprocess)
+        self.unsup_reader = ImageReader(unsup_data_dir, self.unsup_pairs.datasetIds, self.unsup_pairs.ions,
+                                        crop_sz, store, preprocess)
+        self.sup_order = np.arange(len(self.sup_pairs))
         self.crop_sz = crop_sz
         self.shuffle = shuffle
         self.seed = seed
@@ -203,9 +466,10 @@ class IteratorPi(object):
         self.output_fname = output_fname
         self.augment = augment
         self.target_noise = target_noise
+        self.uint8_output = uint8_output
 
     def _flow_index(self):
-        data_len = len(self.sup_df)
+        data_len = len(self.sup_pairs)
         while 1:
             if self.seed is None:
                 random_seed = None
@@ -219,7 +483,9 @@ class IteratorPi(object):
                 if self.verbose:
                     print(f'\n************** New epoch. Generator {self.gen_id} *******************')
                 if self.shuffle:
-                    self.sup_df = self.sup_df.sample(data_len, random_state=random_seed)
+                    # same permutation as sup_df.sample(data_len, random_state=random_seed)
+                    random_state = np.random if random_seed is None else np.random.RandomState(random_seed)
+                    self.sup_order = self.sup_order[random_state.choice(data_len, data_len, replace=False)]
 
             current_index = self.batch_index * self.sup_batch_size
             if data_len > current_index + self.sup_batch_size:
@@ -230,76 +496,42 @@ class IteratorPi(object):
                 self.batch_index = 0
             self.total_batches_seen += 1
 
-            yield self.sup_df.iloc[current_index: current_index + current_sup_batch_size], \
-                  self.unsup_df.sample(self.unsup_batch_size), \
-                  current_sup_batch_size, self.unsup_batch_size
+            # same sample as unsup_df.sample(self.unsup_batch_size)
+            yield self.sup_order[current_index: current_index + current_sup_batch_size], \
+                  np.random.choice(len(self.unsup_pairs), self.unsup_batch_size, replace=False)
 
     def next(self):
         with self.lock:
-            sup_df_slice, unsup_df_slice, current_sup_batch_size, current_unsup_batch_size = next(self.index_generator)
-        current_batch_size = current_sup_batch_size + current_unsup_batch_size
-        input1 = np.zeros((current_batch_size, self.crop_sz, self.crop_sz, self.n_channels), dtype=K.floatx())
-        input2 = np.zeros((current_batch_size, self.crop_sz, self.crop_sz, self.n_channels), dtype=K.floatx())
-        output1 = np.zeros((current_batch_size, 1), dtype=K.floatx())
-        output2 = np.zeros((current_batch_size, 1), dtype=K.floatx())
-        batch_fname = []
+            sup_index_array, unsup_index_array = next(self.index_generator)
+        return self._get_batch(sup_index_array, unsup_index_array)
+
+    def _get_batch(self, sup_index_array, unsup_index_array):
+        current_sup_batch_size = len(sup_index_array)
+        current_unsup_batch_size = len(unsup_index_array)
+        sup_base, sup_other = self.sup_pairs.base[sup_index_array], self.sup_pairs.other[sup_index_array]
+        unsup_base, unsup_other = self.unsup_pairs.base[unsup_index_array], self.unsup_pairs.other[unsup_index_array]
+
+        img = np.concatenate([self.sup_reader.read_pairs(sup_base, sup_other),
+                              self.unsup_reader.read_pairs(unsup_base, unsup_other)])
+        input1 = model_input(augment_batch(self.augment, img), self.uint8_output)
+        input2 = model_input(augment_batch(self.augment, img), self.uint8_output)
+        output1 = np.concatenate([noisy_target(self.sup_pairs.target[sup_index_array], self.target_noise),
+                                  np.full(current_unsup_batch_size, -100)]).astype(K.floatx())[:, None]
+        output2 = np.zeros((current_sup_batch_size + current_unsup_batch_size, 1), dtype=K.floatx())
 
         sample_weight1 = np.concatenate([np.ones(current_sup_batch_size, dtype=K.floatx()),
                                          np.zeros(current_unsup_batch_size, dtype=K.floatx())])
-        sample_weight2 = np.ones(current_batch_size, dtype=K.floatx())
-
-        for i, (df_index, row) in enumerate(sup_df_slice.iterrows()):
-            datasetId, baseSf, baseAdduct, otherSf, otherAdduct, rank = row
-            img, base_ion, other_ion = self._make_img(self.sup_data_dir, datasetId,
-                                                      baseSf, baseAdduct, otherSf, otherAdduct)
-
-            img_aug = self.augment(img)
-            input1[i] = img_aug
-            output1[i] = np.clip(rank + np.random.uniform(-self.target_noise, self.target_noise) * 10, 0, 10) / 10
-
-            img_aug = self.augment(img)
-            input2[i] = img_aug
-            output2[i] = 0
-
-            batch_fname.append((datasetId, base_ion, other_ion))
-
-        for i, (df_index, row) in enumerate(unsup_df_slice.iterrows()):
-            datasetId, baseSf, baseAdduct, otherSf, otherAdduct, rank = row
-            img, base_ion, other_ion = self._make_img(self.unsup_data_dir, datasetId,
-                                                      baseSf, baseAdduct, otherSf, otherAdduct)
-            img_aug = self.augment(img)
-            input1[i + current_sup_batch_size] = img_aug
-            output1[i + current_sup_batch_size] = -100
-
-            img_aug = self.augment(img)
-            input2[i + current_sup_batch_size] = img_aug
-            output2[i + current_sup_batch_size] = 0
-
-            batch_fname.append((datasetId, base_ion, other_ion))
-
-        input1 = preprocess(input1)
-        input2 = preprocess(input2)
-
-        if K.image_data_format() == 'channels_first':   # theano format
-            input1 = np.moveaxis(input1, -1, 1)
-            input2 = np.moveaxis(input2, -1, 1)
+        sample_weight2 = np.ones(current_sup_batch_size + current_unsup_batch_size, dtype=K.floatx())
 
         result = [input1, input2], [output1, output2], [sample_weight1, sample_weight2]
         if self.output_fname:
+            batch_fname = list(zip(self.sup_pairs.datasetIds[sup_base],
+                                   self.sup_pairs.ions[sup_base], self.sup_pairs.ions[sup_other]))
+            batch_fname += list(zip(self.unsup_pairs.datasetIds[unsup_base],
+                                    self.unsup_pairs.ions[unsup_base], self.unsup_pairs.ions[unsup_other]))
             result += (batch_fname,)
         return result
 
-    def _make_img(self, dir, datasetId, baseSf, baseAdduct, otherSf, otherAdduct):
-        base_ion = '.'.join((baseSf, baseAdduct.replace('+', 'p').replace('-', 'm')))
-        other_ion = '.'.join((otherSf, otherAdduct.replace('+', 'p').replace('-', 'm')))
-        first_img = str(dir / '.'.join((datasetId, base_ion, 'tif')))
-        other_img = str(dir / '.'.join((datasetId, other_ion, 'tif')))
-        img = np.stack([cv2.imread(first_img, cv2.IMREAD_GRAYSCALE),
-                        cv2.imread(other_img, cv2.IMREAD_GRAYSCALE)],
-                       axis=-1)
-        img = cv2.resize(img, dsize=(self.crop_sz, self.crop_sz), interpolation=cv2.INTER_CUBIC)
-        return img, base_ion, other_ion
-
     def __iter__(self):
         # Needed if we want to do something like:
         # for x, y in data_gen.flow(...):
@@ -316,15 +548,21 @@ class IteratorMu(object):
     def __init__(self, data_dir, df, crop_sz,
                  augment=null_transform, validation_mode=False,
                  shuffle=True, seed=None, infinite_loop=True, batch_size=32,
-                 verbose=False, gen_id='', output_fname=False):
+                 verbose=False, gen_id='', output_fname=False, store=None, uint8_output=False,
+                 preprocess=None):
         self.lock = threading.Lock()
         self.data_dir = data_dir
         self.df = df
-        if not validation_mode:
-            df['dataset'] = df['files'].apply(lambda f: f.split('.')[0])
-            self.dataset_dict = {g[0]: list(g[1]['files']) for g in df.groupby('dataset')}
-            self.dataset_dict = {k: v for k, v in self.dataset_dict.items() if len(v) > 1}
+        if validation_mode:
+            self.pairs = PairIndex(df)
+            self.datasetIds, self.ions = self.pairs.datasetIds, self.pairs.ions
+        else:
+            # image files '<datasetId>.<ion>.tif'
+            self.datasetIds, self.ions = split_image_names(df['files'].str.slice(stop=-len('.tif')))
+            self.dataset_dict = {k: v for k, v in pd.Series(self.datasetIds).groupby(self.datasetIds).indices.items()
+                                 if len(v) > 1}
             self.dataset_list = list(self.dataset_dict)
+        self.reader = ImageReader(data_dir, self.datasetIds, self.ions, crop_sz, store, preprocess)
         self.crop_sz = crop_sz
         self.shuffle = shuffle
         self.seed = seed
@@ -337,6 +575,7 @@ class IteratorMu(object):
         self.output_fname = output_fname
         self.augment = augment
         self.validation_mode = validation_mode
+        self.uint8_output = uint8_output
         if validation_mode:
             self.index_generator = self._flow_index_val()
         else:
@@ -368,16 +607,16 @@ class IteratorMu(object):
                 self.batch_index = 0
             self.total_batches_seen += 1
 
-            images = []
-            for dataset in self.dataset_list[current_index: current_index + current_batch_size]:
+            image_ids = np.zeros((current_batch_size, 2), dtype=np.intp)
+            for i, dataset in enumerate(self.dataset_list[current_index: current_index + current_batch_size]):
                 if self.shuffle:
                     np.random.RandomState(random_seed).shuffle(self.dataset_dict[dataset])
-                images.append(self.dataset_dict[dataset][:2] + [None])
+                image_ids[i] = self.dataset_dict[dataset][:2]
 
-            yield images, current_batch_size
+            yield image_ids[:, 0], image_ids[:, 1], None
 
     def _flow_index_val(self):
-        data_len = len(self.df)
+        data_len = len(self.pairs)
         while 1:
             # next epoch
             if (self.batch_index == 0) and (self.total_batches_seen > 0):
@@ -391,66 +630,38 @@ class IteratorMu(object):
                 self.batch_index = 0
             self.total_batches_seen += 1
 
-            images = []
-            for _, row in self.df.iloc[current_index: current_index + current_batch_size].iterrows():
-                datasetId, baseSf, baseAdduct, otherSf, otherAdduct, rank = row.values
-                base_ion = '.'.join((baseSf, baseAdduct.replace('+', 'p').replace('-', 'm')))
-                other_ion = '.'.join((otherSf, otherAdduct.replace('+', 'p').replace('-', 'm')))
-                first_img = '.'.join((datasetId, base_ion, 'tif'))
-                other_img = '.'.join((datasetId, other_ion, 'tif'))
-                images.append([first_img, other_img, rank])
-
-            yield images, current_batch_size
+            index_array = np.arange(current_index, current_index + current_batch_size)
+            yield self.pairs.base[index_array], self.pairs.other[index_array], self.pairs.target[index_array]
 
     def next(self):
         with self.lock:
-            images, current_batch_size = next(self.index_generator)
-        input1 = np.zeros((current_batch_size, self.crop_sz, self.crop_sz, 1), dtype=K.floatx())
-        input2 = np.zeros((current_batch_size, self.crop_sz, self.crop_sz, 1), dtype=K.floatx())
-        output = np.zeros((current_batch_size, 1), dtype=K.floatx())
-        batch_fname = []
-
-        for i, (im1, im2, rank) in enumerate(images):
-            img1 = self._make_img(self.data_dir / im1)
-            img2 = self._make_img(self.data_dir / im2)
-
-            if self.validation_mode:
-                target = rank / 10
-            else:
-                # target = np.random.uniform(0, 1)
-                max_categories = 2
-                target = np.random.randint(max_categories) / (max_categories - 1)
-                img2 = cv2.addWeighted(img1, (1 - target), img2, target, 0)
-
-            img_aug = self.augment(np.stack([img1, img2], axis=-1))
-            input1[i] = img_aug[..., [0]]
-            input2[i] = img_aug[..., [1]]
-            output[i] = target
-
-            parse = re.match('([^.]+).(.+).tif', im1)
-            datasetId = parse[1]
-            base_ion = parse[2]
-            parse = re.match('([^.]+).(.+).tif', im2)
-            other_ion = parse[2]
-            batch_fname.append((datasetId, base_ion, other_ion))
-
-        input1 = preprocess(input1)
-        input2 = preprocess(input2)
-
-        if K.image_data_format() == 'channels_first':   # theano format
-            input1 = np.moveaxis(input1, -1, 1)
-            input2 = np.moveaxis(input2, -1, 1)
+            base, other, rank = next(self.index_generator)
+        return self._get_batch(base, other, rank)
+
+    def _get_batch(self, base, other, rank):
+        img1 = self.reader.read(base)
+        img2 = self.reader.read(other)
+
+        if self.validation_mode:
+            target = rank / 10
+        else:
+            # target = np.random.uniform(0, 1, len(base))
+            max_categories = 2
+            target = np.random.randint(max_categories, size=len(base)) / (max_categories - 1)
+            # vectorized cv2.addWeighted(img1, (1 - target), img2, target, 0)
+            weight = target[:, None, None]
+            img2 = np.clip(np.rint(img1 * (1 - weight) + img2 * weight), 0, 255).astype(np.uint8)
+
+        img_aug = augment_batch(self.augment, np.stack([img1, img2], axis=-1))
+        input1 = model_input(img_aug[..., 0: 1], self.uint8_output)
+        input2 = model_input(img_aug[..., 1: 2], self.uint8_output)
+        output = target.astype(K.floatx())[:, None]
 
         result = [input1, input2], output
         if self.output_fname:
-            result += (batch_fname,)
+            result += (list(zip(self.datasetIds[base], self.ions[base], self.ions[other])),)
         return result
 
-    def _make_img(self, image_path):
-        img = cv2.imread(str(image_path), cv2.IMREAD_GRAYSCALE)
-        img = cv2.resize(img, dsize=(self.crop_sz, self.crop_sz), interpolation=cv2.INTER_CUBIC)
-        return img
-
     def __iter__(self):
         # Needed if we want to do something like:
         # for x, y in data_gen.flow(...):
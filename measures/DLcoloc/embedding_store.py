@@ -0,0 +1,75 @@
+import numpy as np
+import pandas as pd
+from pathlib import Path
+
+
+INDEX_FNAME = 'embd.{}.sz{}.csv'
+EMBEDDINGS_FNAME = 'embd.{}.sz{}.npy'
+
+
+class EmbeddingStore(object):
+    """Embeddings of ion images by one model, keyed by (datasetId, ion).
+
+    A store belongs to a weights file and a crop size, its files in `store_dir` are named after both.
+    Each image is embedded once: `update` only runs the model on images missing from the store,
+    and `save` persists the store, so later runs score pairs by lookup.
+    """
+
+    def __init__(self, store_dir, weights_path, crop_sz):
+        self.store_dir = Path(store_dir)
+        self.weights_name = Path(weights_path).stem
+        self.crop_sz = crop_sz
+        self.index_path = self.store_dir / INDEX_FNAME.format(self.weights_name, crop_sz)
+        self.embeddings_path = self.store_dir / EMBEDDINGS_FNAME.format(self.weights_name, crop_sz)
+        if self.index_path.exists() and self.embeddings_path.exists():
+            self.index = pd.read_csv(self.index_path)
+            self.embeddings = np.load(self.embeddings_path)
+            assert len(self.index) == len(self.embeddings)
+        else:
+            self.index = pd.DataFrame(columns=['datasetId', 'ion'])
+            self.embeddings = None
+        self._multi_index = pd.MultiIndex.from_frame(self.index[['datasetId', 'ion']])
+
+    def __len__(self):
+        return len(self.index)
+
+    def _rows(self, datasetIds, ions):
+        return self._multi_index.get_indexer(pd.MultiIndex.from_arrays([datasetIds, ions]))
+
+    def contains(self, datasetIds, ions):
+        """Boolean mask of images already in the store"""
+        return self._rows(datasetIds, ions) >= 0
+
+    def get(self, datasetIds, ions):
+        """(len(datasetIds), embd_dim) embeddings"""
+        rows = self._rows(datasetIds, ions)
+        if (rows < 0).any():
+            i = np.flatnonzero(rows < 0)[0]
+            raise KeyError((datasetIds[i], ions[i]))
+        return self.embeddings[rows]
+
+    def add(self, datasetIds, ions, embeddings):
+        keep = ~self.contains(datasetIds, ions)
+        index = pd.DataFrame({'datasetId': np.asarray(datasetIds)[keep], 'ion': np.asarray(ions)[keep]})
+        embeddings = np.asarray(embeddings)[keep]
+        self.index = pd.concat([self.index, index], ignore_index=True)
+        self.embeddings = embeddings if self.embeddings is None else np.concatenate([self.embeddings, embeddings])
+        self._multi_index = pd.MultiIndex.from_frame(self.index[['datasetId', 'ion']])
+
+    def update(self, datasetIds, ions, embed):
+        """Embed the images not in the store yet, `embed(ids)` gets positions in `datasetIds`/`ions`.
+        Returns the number of embedded images."""
+        missing = np.flatnonzero(~self.contains(datasetIds, ions))
+        if len(missing) > 0:
+            self.add(np.asarray(datasetIds)[missing], np.asarray(ions)[missing], embed(missing))
+        return len(missing)
+
+    def save(self):
+        if self.embeddings is None:
+            return
+        Path.mkdir(self.store_dir, parents=True, exist_ok=True)
+        if self.index_path.exists():
+            self.index_path.unlink()
+        np.save(self.embeddings_path, self.embeddings)
+        # index is written last, so an interrupted save is never loaded
+        self.index.to_csv(self.index_path, index=False)
@@ -0,0 +1,115 @@
+import os
+import pickle
+import argparse
+import numpy as np
+import pandas as pd
+from pathlib import Path
+from image_store import parse_image_name
+
+
+FEATURES_EXT = '.npy'
+INDEX_EXT = '.csv'
+DICT_EXT = '.pkl'
+
+
+def store_stem(path):
+    """'features.ncomp20.naugs40[.pkl|.npy|.csv]' -> 'features.ncomp20.naugs40'"""
+    path = Path(path)
+    return path.with_suffix('') if path.suffix in (FEATURES_EXT, INDEX_EXT, DICT_EXT) else path
+
+
+class FeatureStore(object):
+    """Feature vectors of ion images, e.g. U-map features of train_unsupervised_model.py, keyed by (datasetId, ion).
+
+    Features are one contiguous float32 matrix `<stem>.npy`, memory-mapped when loaded, `<stem>.csv` maps
+    (datasetId, ion) to its row. Features of many images are gathered by a single fancy index.
+    """
+
+    def __init__(self, path, mmap=True, overwrite=False):
+        stem = store_stem(path)
+        self.features_path = stem.with_name(stem.name + FEATURES_EXT)
+        self.index_path = stem.with_name(stem.name + INDEX_EXT)
+        if self.exists() and not overwrite:
+            self.index = pd.read_csv(self.index_path)
+            self.features = np.load(self.features_path, mmap_mode='r' if mmap else None)
+            assert len(self.index) == len(self.features)
+        else:
+            self.index = pd.DataFrame(columns=['datasetId', 'ion'])
+            self.features = None
+        self._multi_index = pd.MultiIndex.from_frame(self.index[['datasetId', 'ion']])
+
+    def __len__(self):
+        return len(self.index)
+
+    def exists(self):
+        return self.index_path.exists() and self.features_path.exists()
+
+    def rows(self, datasetIds, ions):
+        """Rows of images in the feature matrix, -1 for images not in the store"""
+        return self._multi_index.get_indexer(pd.MultiIndex.from_arrays([datasetIds, ions]))
+
+    def contains(self, datasetIds, ions):
+        return self.rows(datasetIds, ions) >= 0
+
+    def get(self, datasetIds, ions):
+        """(len(datasetIds), n_features) features"""
+        rows = self.rows(datasetIds, ions)
+        if (rows < 0).any():
+            i = np.flatnonzero(rows < 0)[0]
+            raise KeyError((datasetIds[i], ions[i]))
+        return self.features[rows]
+
+    def add(self, datasetIds, ions, features):
+        """Add the images not in the store yet, the first of repeated ones, returns the number of added images"""
+        keep = ~self.contains(datasetIds, ions) & ~pd.MultiIndex.from_arrays([datasetIds, ions]).duplicated()
+        index = pd.DataFrame({'datasetId': np.asarray(datasetIds)[keep], 'ion': np.asarray(ions)[keep]})
+        features = np.asarray(features, dtype=np.float32)[keep]
+        self.index = pd.concat([self.index, index], ignore_index=True)
+        self.features = features if self.features is None else np.concatenate([self.features, features])
+        self._multi_index = pd.MultiIndex.from_frame(self.index[['datasetId', 'ion']])
+        return int(keep.sum())
+
+    def save(self):
+        if self.features is None:
+            return
+        Path.mkdir(self.index_path.parent, parents=True, exist_ok=True)
+        if self.index_path.exists():
+            self.index_path.unlink()
+        # replaced, not overwritten: the features of a loaded store may still be mapped
+        tmp_path = self.features_path.with_name(f'{self.features_path.name}.{os.getpid()}.tmp')
+        with open(tmp_path, 'wb') as f:
+            np.save(f, self.features)
+        os.replace(tmp_path, self.features_path)
+        # index is written last, so an interrupted save is never loaded
+        self.index.to_csv(self.index_path, index=False)
+
+    @staticmethod
+    def from_feature_dict(feature_dict, path):
+        """New store at `path` of a {'<...>/<datasetId>.<ion>.tif': features} dict, `save` replaces an old one"""
+        store = FeatureStore(path, overwrite=True)
+        datasetIds, ions = zip(*map(parse_image_name, feature_dict))
+        store.add(np.array(datasetIds, dtype=object), np.array(ions, dtype=object),
+                  np.stack(list(feature_dict.values())))
+        return store
+
+
+def open_feature_store(path):
+    """Feature store of `path`, converted once from the pickled feature dict `<stem>.pkl` if only that exists"""
+    store = FeatureStore(path)
+    dict_path = store_stem(path).with_name(store_stem(path).name + DICT_EXT)
+    if not store.exists() and dict_path.exists():
+        with open(dict_path, 'rb') as f:
+            store = FeatureStore.from_feature_dict(pickle.load(f), path)
+        store.save()
+        store = FeatureStore(path)
+    return store
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('features', help='features dict .pkl dumped by train_unsupervised_model.py, '
+                                         'converted to a feature store beside it')
+    args = parser.parse_args()
+
+    store = open_feature_store(args.features)
+    print(f'{len(store)} images x {store.features.shape[1]} features in {store.features_path}')
@@ -0,0 +1,142 @@
+import os
+import hashlib
+import multiprocessing as mp
+from multiprocessing.connection import wait
+from contextlib import contextmanager
+from pathlib import Path
+import numpy as np
+import pandas as pd
+
+
+# thread pools of numpy, TensorFlow, LightGBM and numba, sized to the CPUs of a worker
+THREAD_VARS = ('OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'NUMEXPR_NUM_THREADS',
+               'NUMBA_NUM_THREADS', 'TF_NUM_INTRAOP_THREADS')
+PART_FNAME = '{}.{}.csv'    # name of the run, task key
+
+
+def available_cpus():
+    return sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else list(range(os.cpu_count()))
+
+
+def split_cpus(n_workers, cpus=None):
+    """CPUs of each worker, contiguous blocks as even as possible, shared round robin if there are fewer CPUs"""
+    cpus = available_cpus() if cpus is None else list(cpus)
+    if n_workers >= len(cpus):
+        return [[cpus[i % len(cpus)]] for i in range(n_workers)]
+    return [list(block) for block in np.array_split(cpus, n_workers)]
+
+
+@contextmanager
+def pinned(cpus):
+    """Processes started within are pinned to `cpus`, with thread pools of as many threads"""
+    environ = {var: os.environ.get(var) for var in THREAD_VARS}
+    os.environ.update({var: str(len(cpus)) for var in THREAD_VARS})
+    affinity = os.sched_getaffinity(0) if hasattr(os, 'sched_setaffinity') else None
+    try:
+        if affinity is not None:
+            # the calling thread only, children inherit its affinity
+            os.sched_setaffinity(0, cpus)
+        yield
+    finally:
+        if affinity is not None:
+            os.sched_setaffinity(0, affinity)
+        for var, value in environ.items():
+            if value is None:
+                os.environ.pop(var, None)
+            else:
+                os.environ[var] = value
+
+
+def inputs_key(*inputs):
+    """Short hash of the input files of a run: path, size and modification time of each file, of every file in
+    a directory, None for a missing input. Part of the run or task name, a run on other inputs doesn't reuse parts."""
+    items = []
+    for p in inputs:
+        if p is None:
+            items.append(None)
+            continue
+        p = Path(p).resolve()
+        files = sorted(f for f in p.rglob('*') if f.is_file()) if p.is_dir() else [p] if p.exists() else []
+        items.append((str(p), [(str(f.relative_to(p)) if f != p else '', f.stat().st_size, f.stat().st_mtime_ns)
+                               for f in files]))
+    return hashlib.sha1(repr(items).encode()).hexdigest()[:10]
+
+
+def part_path(parts_dir, name, key):
+    return Path(parts_dir) / PART_FNAME.format(name, key)
+
+
+def save_part(path, preds):
+    """Predictions of a task, a frame indexed by rows of the gold standard, or None for tasks without"""
+    path = Path(path)
+    Path.mkdir(path.parent, parents=True, exist_ok=True)
+    preds = pd.DataFrame() if preds is None else preds
+    tmp_path = path.with_name(f'{path.name}.{os.getpid()}.tmp')
+    preds.to_csv(tmp_path)
+    # a part exists only complete, it marks the task as done
+    os.replace(tmp_path, path)
+
+
+def load_part(path):
+    try:
+        return pd.read_csv(path, index_col=0)
+    except pd.errors.EmptyDataError:
+        return pd.DataFrame()
+
+
+def _run_task(fun, args, path):
+    save_part(path, fun(*args))
+
+
+def run_folds(fun, tasks, parts_dir, name, workers=None, cpus=None, verbose=True):
+    """Run `fun(*args)` for each (key, args) of `tasks`, typically one per test fold of `utils.train_test_split`,
+    and return {key: part}, the predictions returned by `fun`.
+
+    Each task runs in its own process, at most `workers` at a time (default: all tasks), pinned to its share
+    of `cpus` (default: all available) with thread pools of as many threads. `workers=0` runs tasks in this
+    process. What a task returns is saved as a part file `<parts_dir>/<name>.<key>.csv`; tasks with a part
+    are skipped, so an interrupted run resumes where it stopped."""
+    paths = {key: part_path(parts_dir, name, key) for key, _ in tasks}
+    todo = [(key, args) for key, args in tasks if not paths[key].exists()]
+    if verbose and len(todo) < len(tasks):
+        print(f'{len(tasks) - len(todo)} of {len(tasks)} folds done, parts in {parts_dir}')
+
+    workers = len(todo) if workers is None else workers
+    if workers == 0:
+        for key, args in todo:
+            _run_task(fun, args, paths[key])
+    elif todo:
+        # fresh interpreters: thread pools are sized by the environment when numpy & co are imported
+        ctx = mp.get_context('spawn')
+        cpu_blocks = split_cpus(min(workers, len(todo)), cpus)
+        free, running, failed = list(range(len(cpu_blocks))), {}, []
+        while todo or running:
+            while todo and free:
+                slot, (key, args) = free.pop(0), todo.pop(0)
+                p = ctx.Process(target=_run_task, args=(fun, args, paths[key]), name=f'{name}.{key}')
+                with pinned(cpu_blocks[slot]):
+                    p.start()
+                running[p.sentinel] = slot, key, p
+                if verbose:
+                    print(f'{key}: started on CPUs {cpu_blocks[slot]}')
+            for sentinel in wait(list(running)):
+                slot, key, p = running.pop(sentinel)
+                p.join()
+                free.append(slot)
+                if p.exitcode != 0:
+                    failed.append(key)
+                if verbose:
+                    print(f'{key}: ' + ('done' if p.exitcode == 0 else f'failed, exit code {p.exitcode}'))
+        if failed:
+            raise RuntimeError(f'Folds {failed} failed, parts of the others are saved in {parts_dir}')
+    return {key: load_part(paths[key]) for key, _ in tasks}
+
+
+def merge_parts(df, parts, column='pred'):
+    """`df` with the `column` of all parts, NaN for rows without"""
+    df = df.copy()
+    df[column] = np.nan
+    for part in parts.values():
+        if len(part) > 0:
+            df.loc[part.index, column] = part[column]
+    return df
@@ -0,0 +1,141 @@
+import sys
+import cv2
+import numpy as np
+import pandas as pd
+from pathlib import Path
+import argparse
+
+
+EXT = 'tif'
+CROP_SIZES = (96, 128, 256)
+INDEX_FNAME = 'index.csv'
+IMAGES_FNAME = 'images.sz{}.npy'
+# tissue masks and their bounding boxes are those of the NoLearning measures
+NOLEARNING_DIR = Path(__file__).resolve().parents[1] / 'NoLearning'
+
+
+def parse_image_name(fname):
+    """'<datasetId>.<ion>.tif' -> (datasetId, ion)"""
+    datasetId, ion = Path(fname).stem.split('.', 1)
+    return datasetId, ion
+
+
+class ImageStore(object):
+    """Packed ion images of one crop size.
+
+    All images live in a single memory-mapped uint8 array of shape (n_images, crop_sz, crop_sz),
+    `index.csv` maps (datasetId, ion) to the row of the image. Rows are returned as read-only views,
+    nothing is decoded or resized at training time.
+    """
+
+    def __init__(self, store_dir, crop_sz):
+        self.store_dir = Path(store_dir)
+        self.crop_sz = crop_sz
+        self.index = pd.read_csv(self.store_dir / INDEX_FNAME)
+        self.images = np.load(self.store_dir / IMAGES_FNAME.format(crop_sz), mmap_mode='r')
+        assert len(self.index) == len(self.images)
+        self._offsets = {key: i for i, key in enumerate(zip(self.index['datasetId'], self.index['ion']))}
+        self._multi_index = pd.MultiIndex.from_frame(self.index[['datasetId', 'ion']])
+
+    @staticmethod
+    def exists(store_dir, crop_sz):
+        store_dir = Path(store_dir)
+        return (store_dir / INDEX_FNAME).exists() and (store_dir / IMAGES_FNAME.format(crop_sz)).exists()
+
+    def __len__(self):
+        return len(self.images)
+
+    def __contains__(self, key):
+        return key in self._offsets
+
+    def offset(self, datasetId, ion):
+        return self._offsets[(datasetId, ion)]
+
+    def offsets(self, datasetIds, ions):
+        """Vectorized `offset`"""
+        offsets = self._multi_index.get_indexer(pd.MultiIndex.from_arrays([datasetIds, ions]))
+        if (offsets < 0).any():
+            i = np.flatnonzero(offsets < 0)[0]
+            raise KeyError((datasetIds[i], ions[i]))
+        return offsets
+
+    def get(self, datasetId, ion):
+        return self.images[self._offsets[(datasetId, ion)]]
+
+
+def dataset_bbox(datasetId, images, method, mask_dir=None):
+    """(row slice, column slice) of the tissue mask bounding box of a dataset, from the mask stored by
+    `coloc_measures.dataset_mask` in `mask_dir/<datasetId>` when there is one, else from the images;
+    the full image for an empty mask or images of different shapes"""
+    if str(NOLEARNING_DIR) not in sys.path:
+        sys.path.append(str(NOLEARNING_DIR))
+    import coloc_measures
+    ds_path = Path(mask_dir) / datasetId if mask_dir is not None else None
+    if ds_path is not None and ds_path.is_dir():
+        mask = coloc_measures.dataset_mask(str(ds_path), method)
+    elif len({img.shape for img in images}) == 1:
+        mask = coloc_measures.tissue_mask(images, method)
+    else:
+        return slice(None), slice(None)
+    h, w = images[0].shape
+    if mask.shape != (h, w):
+        mask = cv2.resize(mask.astype(np.uint8), dsize=(w, h), interpolation=cv2.INTER_NEAREST) > 0
+    bbox = coloc_measures.mask_bbox(mask)
+    return bbox if bbox[0].stop > bbox[0].start else (slice(None), slice(None))
+
+
+def build_store(data_dirs, store_dir, crop_sizes=CROP_SIZES, mask_crop=None, mask_dir=None, verbose=True):
+    """Decode all `*.tif` images in `data_dirs` once and pack them into `store_dir`,
+    one array per crop size. An image found in several directories is taken from the first one.
+    With `mask_crop` ('union' or 'tic'), images are cropped to the tissue mask bounding box of their dataset
+    (`dataset_bbox`) before resizing, the boxes are saved in the index."""
+    store_dir = Path(store_dir)
+    Path.mkdir(store_dir, parents=True, exist_ok=True)
+    if (store_dir / INDEX_FNAME).exists():
+        (store_dir / INDEX_FNAME).unlink()
+
+    image_paths = {}
+    for data_dir in data_dirs:
+        for image_path in sorted(Path(data_dir).glob(f'*.{EXT}')):
+            image_paths.setdefault(parse_image_name(image_path), image_path)
+    keys = list(image_paths)
+    if verbose:
+        print(f'Packing {len(keys)} images, crop sizes {tuple(crop_sizes)}, into {store_dir}')
+
+    stores = [np.lib.format.open_memmap(store_dir / IMAGES_FNAME.format(crop_sz), mode='w+',
+                                        dtype=np.uint8, shape=(len(keys), crop_sz, crop_sz))
+              for crop_sz in crop_sizes]
+    dataset_rows = {}
+    for i, (datasetId, _) in enumerate(keys):
+        dataset_rows.setdefault(datasetId, []).append(i)
+    bboxes = np.zeros((len(keys), 4), dtype=int)
+    for datasetId, rows in dataset_rows.items():
+        imgs = [cv2.imread(str(image_paths[keys[i]]), cv2.IMREAD_GRAYSCALE) for i in rows]
+        bbox = dataset_bbox(datasetId, imgs, mask_crop, mask_dir) if mask_crop else (slice(None), slice(None))
+        for i, img in zip(rows, imgs):
+            img = img[bbox]
+            bboxes[i] = *bbox[0].indices(len(imgs[0]))[:2], *bbox[1].indices(imgs[0].shape[1])[:2]
+            for crop_sz, images in zip(crop_sizes, stores):
+                images[i] = cv2.resize(img, dsize=(crop_sz, crop_sz), interpolation=cv2.INTER_CUBIC)
+    for images in stores:
+        images.flush()
+
+    # index is written last, so an interrupted build is never picked up by `ImageStore.exists`
+    index = pd.DataFrame(keys, columns=['datasetId', 'ion'])
+    if mask_crop:
+        index[['y0', 'y1', 'x0', 'x1']] = bboxes
+    index.to_csv(store_dir / INDEX_FNAME, index=False)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('store_dir', help='path to the packed image store')
+    parser.add_argument('data_dirs', nargs='+', help='paths to gold standard and unsupervised images')
+    parser.add_argument('-crop_sizes', type=int, nargs='+', default=CROP_SIZES, help='crop sizes to pack')
+    parser.add_argument('-mask_crop', default=None, choices=('union', 'tic'),
+                        help='crop images to the tissue mask of their dataset')
+    parser.add_argument('-mask_dir', default=None,
+                        help='NoLearning gold standard images, one directory per dataset, whose stored masks are used')
+    args = parser.parse_args()
+    build_store([Path(d) for d in args.data_dirs], Path(args.store_dir), crop_sizes=args.crop_sizes,
+                mask_crop=args.mask_crop, mask_dir=args.mask_dir)
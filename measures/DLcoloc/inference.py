@@ -1,12 +1,15 @@
 from datagen import Iterator
+from image_store import ImageStore
 from models import xception
+from model_utils import predict_stream
+from inference_engine import InferenceEngine
 import numpy as np
 from stats import accuracy
 import pandas as pd
 import re
 from pathlib import Path
 from utils import train_test_split
-from keras import backend as K
+from folds import run_folds, merge_parts, inputs_key
 import matplotlib.pyplot as plt
 import os
 import argparse
@@ -19,9 +22,47 @@ Path.mkdir(PREDS_DIR, exist_ok=True)
 DATA_DF = pd.read_csv(CURRENT_DIR / '../../GS/coloc_gs.csv')
 COLUMNS = DATA_DF.columns
 BATCH_SIZE = 16
+PREDICT_BATCH_SIZE = 32     # batch size of model.predict, streamed batches match it
 MODEL2CLASS = {'xception': xception,
                'pi_model': xception}
 
+engines = {}    # one network per model, fold weights are swapped in
+
+
+def predict_fold(weights_path, data_dir, store_dir, stream):
+    """Predictions of the model of a checkpoint on its test fold, indexed as DATA_DF"""
+    parse = re.match('checkpoint.(.+).sz([0-9]+).fold([0-9]+)-([0-9]+).', weights_path.parts[-1])
+    model_name = parse[1]
+    crop_sz = int(parse[2])
+    test_fold = int(parse[3])
+    n_folds = int(parse[4])
+    print(f'Model {model_name}, crop size {crop_sz}, fold {test_fold} of {n_folds}')
+
+    _, test_df = train_test_split(DATA_DF[COLUMNS], test_fold=test_fold, n_folds=n_folds)
+    store = ImageStore(store_dir, crop_sz) if store_dir else None
+    val_iterator = Iterator(data_dir, test_df, crop_sz, target_noise=0.0,
+                            shuffle=False, seed=None, infinite_loop=False,
+                            batch_size=PREDICT_BATCH_SIZE if stream else BATCH_SIZE,
+                            verbose=False, gen_id='val', output_fname=False, store=store)
+
+    if model_name not in engines:
+        engines[model_name] = InferenceEngine(MODEL2CLASS[model_name])
+    engines[model_name].add(test_fold, weights_path)
+    model = engines[model_name].use(test_fold)
+    if stream:
+        y_pred, y = predict_stream(model, val_iterator)
+    else:
+        x, y = zip(*val_iterator)
+        x = np.concatenate(x)
+        y = np.concatenate(y)
+        y_pred = model.predict(x, batch_size=PREDICT_BATCH_SIZE)
+    y = y.flatten()
+    y_pred = y_pred.flatten()
+
+    np.testing.assert_array_almost_equal(test_df['rank'], y * 10)
+    accuracy(y * 10, y_pred * 10, f'\nFold {test_fold} accuracy:')
+    return pd.DataFrame({'pred': y_pred * 10}, index=test_df.index)
+
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
@@ -30,6 +71,12 @@ if __name__ == '__main__':
                         default=None,
                         choices=['base', 'pi'],
                         help='model type')
+    parser.add_argument('-store', default=None, required=False, help='path to packed image store')
+    parser.add_argument('-stream', action='store_true', help='predict batch by batch, with memory bounded by a batch')
+    parser.add_argument('-workers', type=int, default=1,
+                        help='folds predicted in parallel processes, pinned to their share of CPUs; with 1 (default, '
+                             'each TF process takes the whole GPU memory) or 0 folds run in this process and share '
+                             'one network. Folds predicted by an earlier run on the same inputs are reused')
     args = parser.parse_args()
     DATA_DIR = Path(args.data_dir)
     MODEL_TYPE = args.model_type
@@ -37,34 +84,15 @@ if __name__ == '__main__':
     PREDS_DF = PREDS_DIR / 'preds_{}.csv'.format(MODEL_TYPE)
     WEIGHTS = list(MODEL_DIR.glob('*.hdf5'))
 
-    for weights_path in WEIGHTS:
-        parse = re.match('checkpoint.(.+).sz([0-9]+).fold([0-9]+)-([0-9]+).', weights_path.parts[-1])
-        model_name = parse[1]
-        crop_sz = int(parse[2])
-        test_fold = int(parse[3])
-        n_folds = int(parse[4])
-        print(f'Model {model_name}, crop size {crop_sz}, fold {test_fold} of {n_folds}')
-
-        _, test_df = train_test_split(DATA_DF[COLUMNS], test_fold=test_fold, n_folds=n_folds)
-        val_iterator = Iterator(DATA_DIR, test_df, crop_sz, target_noise=0.0,
-                                shuffle=False, seed=None, infinite_loop=False, batch_size=BATCH_SIZE,
-                                verbose=False, gen_id='val', output_fname=False)
-
-        x, y = zip(*val_iterator)
-        x = np.concatenate(x)
-        y = np.concatenate(y).flatten()
-
-        model_class = MODEL2CLASS[model_name]
-        K.clear_session()
-        model = model_class(weights=weights_path)
-        y_pred = model.predict(x).flatten()
-
-        DATA_DF.loc[test_df.index, 'pred'] = y_pred * 10
-        np.testing.assert_array_almost_equal(DATA_DF.loc[test_df.index, 'rank'], y * 10)
-
-        accuracy(y * 10, y_pred * 10, f'\nFold {test_fold} accuracy:')
+    # one task per checkpoint, its predictions are saved as a part in PREDS_DIR/parts,
+    # named by the checkpoint and the images, parts of other checkpoints or images are not reused
+    tasks = [(f'{weights_path.stem}.{inputs_key(weights_path)}', (weights_path, DATA_DIR, args.store, args.stream))
+             for weights_path in WEIGHTS]
+    parts = run_folds(predict_fold, tasks, PREDS_DIR / 'parts',
+                      f'preds_{MODEL_TYPE}.{inputs_key(args.store or DATA_DIR)}',
+                      args.workers if args.workers > 1 else 0)
 
-    df_preds = DATA_DF.dropna()
+    df_preds = merge_parts(DATA_DF, parts).dropna()
     df_preds.to_csv(PREDS_DF, index=False)
     accuracy(df_preds['rank'], df_preds['pred'], f'\nTotal preds {len(df_preds)}:')
 
@@ -0,0 +1,51 @@
+import numpy as np
+
+
+class InferenceEngine(object):
+    """One network for all checkpoints of a model.
+
+    The architecture is built once, without ImageNet weights and without compiling an optimizer.
+    Checkpoints are loaded once with `add` and kept in memory as weight lists, `use` swaps them in,
+    so switching between folds costs a `set_weights` instead of rebuilding the model.
+    `model_fn` is `models.xception` or `models.mu_model`, `model_args` are passed on to it.
+    """
+
+    def __init__(self, model_fn, **model_args):
+        self.model = model_fn(pretrained=False, compile=False, **model_args)
+        self.fold_weights = {}
+        self.current = None
+
+    def add(self, key, weights_path):
+        print('Load weights from', weights_path)
+        self.model.load_weights(str(weights_path))
+        self.fold_weights[key] = self.model.get_weights()
+        self.current = key
+
+    def use(self, key):
+        if key != self.current:
+            self.model.set_weights(self.fold_weights[key])
+            self.current = key
+        return self.model
+
+    def predict(self, x, key, batch_size=32):
+        return self.use(key).predict(x, batch_size=batch_size)
+
+    def predict_ensemble(self, batches, keys=None):
+        """Mean prediction of the checkpoints `keys` (all by default) over one pass of `batches`,
+        which yields model inputs or tuples (x, y, ...) as the datagen iterators do.
+        Every batch is read once and run through each checkpoint in turn.
+        Returns predictions, and targets when the batches have them."""
+        keys = list(self.fold_weights) if keys is None else list(keys)
+        y_pred = []
+        y_true = []
+        for batch in batches:
+            x = batch[0] if isinstance(batch, tuple) else batch
+            # keep the last checkpoint of a batch for the first of the next, one swap less per batch
+            order = keys if len(y_pred) % 2 == 0 else keys[::-1]
+            preds = {key: self.use(key).predict_on_batch(x) for key in order}
+            y_pred.append(np.mean([preds[key] for key in keys], axis=0))
+            if isinstance(batch, tuple):
+                y_true.append(batch[1])
+        y_pred = np.concatenate(y_pred)
+        return (y_pred, np.concatenate(y_true)) if y_true else y_pred
+
@@ -1,13 +1,17 @@
-from datagen import Iterator
+from datagen import ImageReader, model_input
+from image_store import ImageStore
+from embedding_store import EmbeddingStore
 from models import mu_model
+from model_utils import predict_stream
+from inference_engine import InferenceEngine
 import numpy as np
 from stats import accuracy
-from scipy.stats import spearmanr, pearsonr
+from scoring import pearson_distance
 import pandas as pd
 import re
 from pathlib import Path
-from utils import train_test_split
-from keras import backend as K
+from utils import train_test_split, PairIndex
+from folds import run_folds, merge_parts, inputs_key
 import matplotlib.pyplot as plt
 import os
 import argparse
@@ -16,6 +20,7 @@ import argparse
 CURRENT_DIR = Path(os.path.dirname(os.path.abspath(__file__)))
 PREDS_DIR = Path(CURRENT_DIR / 'prediction')
 Path.mkdir(PREDS_DIR, exist_ok=True)
+EMBD_DIR = Path(CURRENT_DIR / 'embeddings')
 
 DATA_DF = pd.read_csv(CURRENT_DIR / '../../GS/coloc_gs.csv')
 COLUMNS = DATA_DF.columns
@@ -23,11 +28,63 @@ BATCH_SIZE = 16
 
 MODEL2CLASS = {'mu_model': mu_model}
 
+engines = {}    # one network per model and embedding size, fold weights are swapped in
+
+
+def predict_fold(weights_path, data_dir, store_dir, embd_dir):
+    """Predictions of the model of a checkpoint on its test fold, indexed as DATA_DF"""
+    parse = re.match('checkpoint.(.+).embd([0-9]+).sz([0-9]+).fold([0-9]+)-([0-9]+).', weights_path.parts[-1])
+    model_name = parse[1]
+    embd_dim = int(parse[2])
+    crop_sz = int(parse[3])
+    test_fold = int(parse[4])
+    n_folds = int(parse[5])
+    print(f'Model {model_name}, embd_dim {embd_dim}, crop size {crop_sz}, fold {test_fold} of {n_folds}')
+
+    _, test_df = train_test_split(DATA_DF[COLUMNS], test_fold=test_fold, n_folds=n_folds)
+    store = ImageStore(store_dir, crop_sz) if store_dir else None
+    pairs = PairIndex(test_df)
+    reader = ImageReader(data_dir, pairs.datasetIds, pairs.ions, crop_sz, store)
+
+    def embed(image_ids):
+        if (model_name, embd_dim) not in engines:
+            engines[(model_name, embd_dim)] = InferenceEngine(MODEL2CLASS[model_name], embd_dim=embd_dim,
+                                                              return_core_model=True)
+        engine = engines[(model_name, embd_dim)]
+        if test_fold not in engine.fold_weights:
+            engine.add(test_fold, weights_path)
+        model = engine.use(test_fold)
+        batches = (model_input(reader.read(image_ids[i: i + BATCH_SIZE])[..., None])
+                   for i in range(0, len(image_ids), BATCH_SIZE))
+        return predict_stream(model, batches)
+
+    # every image is embedded once, pairs are scored by lookup
+    embeddings = EmbeddingStore(embd_dir, weights_path, crop_sz)
+    n_embedded = embeddings.update(pairs.datasetIds, pairs.ions, embed)
+    embeddings.save()
+    print(f'Embedded {n_embedded} of {len(pairs.ions)} images')
+
+    feats = embeddings.get(pairs.datasetIds, pairs.ions)
+    feat0 = feats[pairs.base]
+    feat1 = feats[pairs.other]
+    y = pairs.target / 10.
+    y_pred = pearson_distance(feat0, feat1)
+
+    np.testing.assert_array_almost_equal(test_df['rank'], y * 10)
+    accuracy(y * 10, y_pred * 10, f'\nFold {test_fold} accuracy:')
+    return pd.DataFrame({'pred': y_pred * 10}, index=test_df.index)
+
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('data_dir',
                         default=None)
+    parser.add_argument('-store', default=None, required=False, help='path to packed image store')
+    parser.add_argument('-embd_dir', default=EMBD_DIR, required=False, help='path to stored image embeddings')
+    parser.add_argument('-workers', type=int, default=1,
+                        help='folds predicted in parallel processes, pinned to their share of CPUs; with 1 (default, '
+                             'each TF process takes the whole GPU memory) or 0 folds run in this process and share '
+                             'one network. Folds predicted by an earlier run on the same inputs are reused')
     args = parser.parse_args()
     DATA_DIR = Path(args.data_dir)
     MODEL_TYPE = 'mu'
@@ -35,40 +92,16 @@ if __name__ == '__main__':
     PREDS_DF = PREDS_DIR / 'preds_{}.csv'.format(MODEL_TYPE)
     WEIGHTS = list(MODEL_DIR.glob('*.hdf5'))
 
-    for weights_path in WEIGHTS:
-        parse = re.match('checkpoint.(.+).embd([0-9]+).sz([0-9]+).fold([0-9]+)-([0-9]+).', weights_path.parts[-1])
-        model_name = parse[1]
-        embd_dim = int(parse[2])
-        crop_sz = int(parse[3])
-        test_fold = int(parse[4])
-        n_folds = int(parse[5])
-        print(f'Model {model_name}, embd_dim {embd_dim}, crop size {crop_sz}, fold {test_fold} of {n_folds}')
-
-        _, test_df = train_test_split(DATA_DF[COLUMNS], test_fold=test_fold, n_folds=n_folds)
-        val_iterator = Iterator(DATA_DIR, test_df, crop_sz, target_noise=0.0,
-                                shuffle=False, seed=None, infinite_loop=False, batch_size=BATCH_SIZE,
-                                verbose=False, gen_id='val', output_fname=False)
-
-        x, y = zip(*val_iterator)
-        x = np.concatenate(x)
-        x0 = x[..., [0]]
-        x1 = x[..., [1]]
-        y = np.concatenate(y).flatten()
-
-        model_class = MODEL2CLASS[model_name]
-        K.clear_session()
-        model = model_class(weights=MODEL_DIR / weights_path, embd_dim=embd_dim, return_core_model=True)
-
-        feat0 = model.predict(x0)
-        feat1 = model.predict(x1)
-        y_pred = np.array([1 - pearsonr(f0, f1)[0] for f0, f1 in zip(feat0, feat1)])
-
-        DATA_DF.loc[test_df.index, 'pred'] = y_pred * 10
-        np.testing.assert_array_almost_equal(DATA_DF.loc[test_df.index, 'rank'], y * 10)
-
-        accuracy(y * 10, y_pred * 10, f'\nFold {test_fold} accuracy:')
+    # one task per checkpoint, its predictions are saved as a part in PREDS_DIR/parts,
+    # named by the checkpoint and the images, parts of other checkpoints or images are not reused
+    tasks = [(f'{weights_path.stem}.{inputs_key(MODEL_DIR / weights_path)}',
+              (MODEL_DIR / weights_path, DATA_DIR, args.store, args.embd_dir))
+             for weights_path in WEIGHTS]
+    parts = run_folds(predict_fold, tasks, PREDS_DIR / 'parts',
+                      f'preds_{MODEL_TYPE}.{inputs_key(args.store or DATA_DIR)}',
+                      args.workers if args.workers > 1 else 0)
 
-    df_preds = DATA_DF.dropna()
+    df_preds = merge_parts(DATA_DF, parts).dropna()
     df_preds.to_csv(PREDS_DF, index=False)
     accuracy(df_preds['rank'], df_preds['pred'], f'\nTotal preds {len(df_preds)}:')
 
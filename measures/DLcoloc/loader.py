@@ -0,0 +1,156 @@
+import numpy as np
+import multiprocessing as mp
+from multiprocessing.shared_memory import SharedMemory
+from multiprocessing import resource_tracker
+import traceback
+import random
+import copy
+
+
+ALIGN = 64
+
+
+def _flatten(batch, arrays):
+    """Replace arrays in a nested list/tuple batch with their position in `arrays`"""
+    if isinstance(batch, np.ndarray):
+        arrays.append(batch)
+        return 'a', len(arrays) - 1
+    if isinstance(batch, (list, tuple)):
+        return ('l' if isinstance(batch, list) else 't'), [_flatten(b, arrays) for b in batch]
+    return 'o', batch
+
+
+def _unflatten(structure, arrays):
+    kind, value = structure
+    if kind == 'a':
+        return arrays[value]
+    if kind == 'l':
+        return [_unflatten(s, arrays) for s in value]
+    if kind == 't':
+        return tuple(_unflatten(s, arrays) for s in value)
+    return value
+
+
+def _worker(iterator, seed, task_queue, result_queue):
+    np.random.seed(seed)
+    random.seed(seed)
+    slots = {}
+    try:
+        while True:
+            task = task_queue.get()
+            if task is None:
+                break
+            slot, spec = task
+            try:
+                arrays = []
+                structure = _flatten(iterator._get_batch(*spec), arrays)
+                layout = []
+                offset = 0
+                for a in arrays:
+                    layout.append((a.shape, a.dtype.str, offset))
+                    offset += -(-a.nbytes // ALIGN) * ALIGN
+                shm = slots.get(slot)
+                if shm is None or shm.size < offset:
+                    if shm is not None:
+                        shm.close()
+                        shm.unlink()
+                    shm = slots[slot] = SharedMemory(create=True, size=max(offset, 1))
+                for a, (shape, dtype, offset) in zip(arrays, layout):
+                    np.ndarray(shape, dtype, buffer=shm.buf, offset=offset)[...] = a
+                result_queue.put((shm.name, layout, structure))
+            except Exception:
+                result_queue.put(traceback.format_exc())
+    finally:
+        result_queue.cancel_join_thread()
+        for shm in slots.values():
+            shm.close()
+            shm.unlink()
+
+
+class ProcessLoader(object):
+    """Builds batches of a datagen iterator (`Iterator`, `IteratorPi`, `IteratorMu`) in worker processes.
+
+    The iterator's index generator keeps running in this process, so shuffling, seeds and epochs are
+    exactly those of `_flow_index`. Batch k is built by worker k % workers, which is seeded with its own
+    deterministic stream, into one of its `prefetch` shared memory slots. Batches are returned as views of
+    the slot: only index arrays and array layouts pass through the queues, never the batch data.
+    A returned batch stays valid until the next one is requested, so use it with `fit_generator(..., workers=0)`.
+    On platforms without `fork` the iterator, including its `augment`, must be picklable.
+    """
+
+    def __init__(self, iterator, workers=3, prefetch=2, seed=None):
+        assert workers >= 1 and prefetch >= 1
+        self.iterator = iterator
+        self.workers = workers
+        self.prefetch = prefetch
+        self.seed = iterator.seed if seed is None else seed
+        self.batches_submitted = 0
+        self.batches_returned = 0
+        self.exhausted = False
+        self._shm = {}
+
+        ctx = mp.get_context('fork') if 'fork' in mp.get_all_start_methods() else mp.get_context()
+        resource_tracker.ensure_running()     # workers must share it with us, else their segments look leaked here
+        worker_iterator = copy.copy(iterator)
+        del worker_iterator.lock, worker_iterator.index_generator
+        seeds = np.random.SeedSequence(self.seed).spawn(workers)
+        self.task_queues = [ctx.Queue() for _ in range(workers)]
+        self.result_queues = [ctx.Queue() for _ in range(workers)]
+        self.processes = [ctx.Process(target=_worker, daemon=True,
+                                      args=(worker_iterator, int(s.generate_state(1)[0]), task_queue, result_queue))
+                          for s, task_queue, result_queue in zip(seeds, self.task_queues, self.result_queues)]
+        for p in self.processes:
+            p.start()
+
+    def _submit(self):
+        # batch k reuses the slot of batch k - workers * prefetch, which has been returned and released by now
+        while not self.exhausted and self.batches_submitted < self.batches_returned + self.workers * self.prefetch:
+            with self.iterator.lock:
+                spec = next(self.iterator.index_generator, None)
+            if spec is None:
+                self.exhausted = True
+                break
+            worker = self.batches_submitted % self.workers
+            slot = (self.batches_submitted // self.workers) % self.prefetch
+            self.task_queues[worker].put((slot, spec if isinstance(spec, tuple) else (spec,)))
+            self.batches_submitted += 1
+
+    def next(self):
+        self._submit()
+        if self.batches_returned == self.batches_submitted:
+            raise StopIteration
+        result = self.result_queues[self.batches_returned % self.workers].get()
+        self.batches_returned += 1
+        if isinstance(result, str):
+            raise RuntimeError(f'Batch failed in worker process:\n{result}')
+
+        name, layout, structure = result
+        shm = self._shm.get(name)
+        if shm is None:
+            shm = self._shm[name] = SharedMemory(name=name)
+        arrays = [np.ndarray(shape, dtype, buffer=shm.buf, offset=offset) for shape, dtype, offset in layout]
+        return _unflatten(structure, arrays)
+
+    def close(self):
+        for task_queue in self.task_queues:
+            task_queue.put(None)
+        for p in self.processes:
+            p.join()
+        self.processes = []
+        self.task_queues = []
+        for shm in self._shm.values():
+            try:
+                shm.close()
+            except BufferError:     # a batch view is still alive, the mapping goes with it
+                pass
+        self._shm = {}
+
+    def __iter__(self):
+        return self
+
+    def __next__(self, *args, **kwargs):
+        return self.next(*args, **kwargs)
+
+    def __del__(self):
+        if getattr(self, 'processes', None):
+            self.close()
@@ -1,4 +1,6 @@
 # -*- coding: utf-8 -*-
+import numpy as np
+
 
 def get_scheduler(lr_steps: dict):
     def scheduler(epoch):
@@ -10,3 +12,19 @@ def get_scheduler(lr_steps: dict):
         return lr
 
     return scheduler
+
+
+def predict_stream(model, batches):
+    """Predict batches one at a time, peak memory is a batch instead of the whole set.
+    `batches` yields model inputs, or tuples (x, y, ...) as the datagen iterators do.
+    Returns predictions, and targets when the batches have them.
+    Results equal `model.predict(np.concatenate(x), batch_size=n)` when the batches have n samples."""
+    y_pred = []
+    y_true = []
+    for batch in batches:
+        x = batch[0] if isinstance(batch, tuple) else batch
+        y_pred.append(model.predict_on_batch(x))
+        if isinstance(batch, tuple):
+            y_true.append(batch[1])
+    y_pred = np.concatenate(y_pred)
+    return (y_pred, np.concatenate(y_true)) if y_true else y_pred
@@ -133,7 +133,22 @@ def correlation_loss(a):
     return 1 - correlation(a)
 
 
-def xception(input_channels=2, lr=1e-4, weights=None, optimizer='adam'):
+def scale_input(x):
+    """datagen.preprocess in the graph: uint8 [0, 255] -> [-1, 1]"""
+    return K.cast(x, K.floatx()) / 255. * 2. - 1.0
+
+
+def input_layer(input_shape, input_scaling=False):
+    """Input layer and its output, which takes uint8 images and scales them when `input_scaling` is set"""
+    if not input_scaling:
+        input = Input(input_shape)
+        return input, input
+    input = Input(input_shape, dtype='uint8')
+    return input, Lambda(scale_input, name='scale_input')(input)
+
+
+def xception(input_channels=2, lr=1e-4, weights=None, optimizer='adam', input_scaling=False,
+             pretrained=True, compile=True):
 
     if K.image_data_format() == 'channels_last':
         input_shape = (None, None, input_channels)
@@ -142,10 +157,11 @@ def xception(input_channels=2, lr=1e-4, weights=None, optimizer='adam'):
         input_shape = (input_channels, None, None)
         input_shape_xception = (3, None, None)
 
-    xception_model = Xception(input_shape=input_shape_xception, include_top=False, weights='imagenet')
+    xception_model = Xception(input_shape=input_shape_xception, include_top=False,
+                              weights='imagenet' if pretrained else None)
 
-    main_input = Input(input_shape)
-    x = Convolution2D(3, (1, 1), kernel_initializer='he_normal')(main_input)
+    main_input, x = input_layer(input_shape, input_scaling)
+    x = Convolution2D(3, (1, 1), kernel_initializer='he_normal')(x)
     x = xception_model(x)
     x = GlobalAveragePooling2D(name='pool1')(x)
     output_activation = 'linear'
@@ -157,6 +173,9 @@ def xception(input_channels=2, lr=1e-4, weights=None, optimizer='adam'):
         print('Load weights from', weights)
         model.load_weights(weights)
 
+    if not compile:     # inference only
+        return model
+
     if optimizer.lower() == 'adam':
         optimizer = Adam(lr, decay=0.0005)
         print('Optimizer is Adam')
@@ -171,7 +190,8 @@ def xception(input_channels=2, lr=1e-4, weights=None, optimizer='adam'):
     return model
 
 
-def pi_model(input_channels=2, lr=1e-4, weights=None, optimizer='adam', loss_weights=(0.5, 0.5)):
+def pi_model(input_channels=2, lr=1e-4, weights=None, optimizer='adam', loss_weights=(0.5, 0.5),
+             input_scaling=False):
     """ Pi-model. https://arxiv.org/pdf/1610.02242.pdf """
 
     if K.image_data_format() == 'channels_last':
@@ -180,9 +200,10 @@ def pi_model(input_channels=2, lr=1e-4, weights=None, optimizer='adam', loss_wei
         input_shape = (input_channels, None, None)
 
     core_model = xception(input_channels=input_channels, lr=lr, optimizer=optimizer,
-                          weights=weights)
-    input1 = Input(input_shape)
-    input2 = Input(input_shape)
+                          weights=weights, input_scaling=input_scaling)
+    input_dtype = 'uint8' if input_scaling else None
+    input1 = Input(input_shape, dtype=input_dtype)
+    input2 = Input(input_shape, dtype=input_dtype)
     x1 = core_model(input1)
     x2 = core_model(input2)
     out1 = Average(name='out1')([x1, x2])
@@ -195,7 +216,8 @@ def pi_model(input_channels=2, lr=1e-4, weights=None, optimizer='adam', loss_wei
     return model
 
 
-def mu_model(lr=1e-4, weights=None, optimizer='adam', embd_dim=128, return_core_model=False):
+def mu_model(lr=1e-4, weights=None, optimizer='adam', embd_dim=128, return_core_model=False, input_scaling=False,
+             pretrained=True, compile=True):
 
     def euclidean_distance(vects):
         x, y = vects
@@ -221,9 +243,10 @@ def mu_model(lr=1e-4, weights=None, optimizer='adam', embd_dim=128, return_core_
         input_shape_xception = (3, None, None)
 
     def create_core_model(input_shape, weights):
-        xception_model = Xception(input_shape=input_shape_xception, include_top=False, weights='imagenet')
-        input = Input(shape=input_shape)
-        x = Convolution2D(3, (1, 1), kernel_initializer='he_normal')(input)
+        xception_model = Xception(input_shape=input_shape_xception, include_top=False,
+                                  weights='imagenet' if pretrained else None)
+        input, x = input_layer(input_shape, input_scaling)
+        x = Convolution2D(3, (1, 1), kernel_initializer='he_normal')(x)
         x = xception_model(x)
         x = GlobalAveragePooling2D(name='pool')(x)
         output = Dense(embd_dim, activation='elu', kernel_initializer='he_normal', name='embd')(x)
@@ -237,7 +260,7 @@ def mu_model(lr=1e-4, weights=None, optimizer='adam', embd_dim=128, return_core_
     if return_core_model:
         return core_model
 
-    input = Input(input_shape)
+    input = Input(input_shape, dtype='uint8' if input_scaling else None)
     if K.image_data_format() == 'channels_last':
         input1 = Lambda(lambda x: x[..., 0: 1])(input)
         input2 = Lambda(lambda x: x[..., 1: 2])(input)
@@ -250,6 +273,9 @@ def mu_model(lr=1e-4, weights=None, optimizer='adam', embd_dim=128, return_core_
 
     model = Model(input, output, name='mu_model')
 
+    if not compile:     # inference only
+        return model
+
     if optimizer.lower() == 'adam':
         optimizer = Adam(lr, decay=0.0005)
         print('Optimizer is Adam')
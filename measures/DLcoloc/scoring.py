@@ -0,0 +1,71 @@
+import numpy as np
+from scipy.stats import rankdata
+
+
+BLOCK_SIZE = 4096   # rows per block in `blocked_distance`
+
+
+def normalize_rows(x, center=True):
+    """Rows scaled to unit norm, centered first for correlations, as float64"""
+    x = np.asarray(x, dtype=np.float64)
+    if center:
+        x = x - x.mean(axis=-1, keepdims=True)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return x / np.linalg.norm(x, axis=-1, keepdims=True)
+
+
+def correlation(a, b):
+    """Pearson r of the rows of `a` and `b`, arrays broadcast like (n, d) <-> (n, d) or (1, d) <-> (n, d).
+    Constant rows give NaN, as scipy.stats.pearsonr."""
+    r = np.einsum('...i,...i->...', normalize_rows(a), normalize_rows(b))
+    return np.clip(r, -1.0, 1.0)
+
+
+def cosine_similarity(a, b):
+    """Cosine similarity of the rows of `a` and `b`"""
+    r = np.einsum('...i,...i->...', normalize_rows(a, False), normalize_rows(b, False))
+    return np.clip(r, -1.0, 1.0)
+
+
+def spearman_correlation(a, b):
+    """Spearman rho of the rows of `a` and `b`, ties get average ranks as in scipy.stats.spearmanr"""
+    return correlation(rankdata(a, axis=-1), rankdata(b, axis=-1))
+
+
+def pearson_distance(a, b):
+    return 1 - correlation(a, b)
+
+
+def cosine_distance(a, b):
+    return 1 - cosine_similarity(a, b)
+
+
+def spearman_distance(a, b):
+    return 1 - spearman_correlation(a, b)
+
+
+DISTANCES = {'pearson': pearson_distance,
+             'cosine': cosine_distance,
+             'spearman': spearman_distance}
+
+
+def rowwise_distance(a, b, metric='pearson'):
+    """Distances between a[i] and b[i]"""
+    return DISTANCES[metric](a, b)
+
+
+def one_vs_many(a, metric='pearson'):
+    """Distances a[0] <-> a[1:] within a group, the base row first"""
+    return DISTANCES[metric](a[:1], a[1:])
+
+
+def blocked_distance(a, b, metric='pearson', block_size=BLOCK_SIZE, out=None):
+    """`rowwise_distance` for matrices that don't fit in memory, e.g. memory-mapped:
+    rows are loaded and scored `block_size` at a time, results are written to `out` when given."""
+    assert len(a) == len(b)
+    if out is None:
+        out = np.empty(len(a), dtype=np.float64)
+    for start in range(0, len(a), block_size):
+        stop = min(start + block_size, len(a))
+        out[start: stop] = DISTANCES[metric](a[start: stop], b[start: stop])
+    return out
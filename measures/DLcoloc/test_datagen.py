@@ -0,0 +1,137 @@
+import cv2
+import numpy as np
+import pytest
+
+pytest.importorskip('keras')
+from albumentations import RandomGamma
+from datagen import BatchTransform
+
+
+B, H, W = 8, 100, 100
+NUM_STEPS = 5
+
+# max abs difference in grey levels between a batched stage and the per-sample path
+GAMMA_TOL = 1
+OPTICAL_TOL = 1
+GRID_TOL = 1
+SSR_TOL = 4
+# on the rim of the rotated frame, cv2's 1/32 fixed-point weights interpolate against the zero border
+RIM_TOL = 255 // 32
+
+
+@pytest.fixture
+def batch():
+    rng = np.random.RandomState(0)
+    img = (rng.rand(B * H, W, 2) * 255).astype(np.uint8)
+    img = cv2.GaussianBlur(img, (9, 9), 3).reshape(B, H, W, 2).astype(float)
+    return ((img - img.min()) / (img.max() - img.min()) * 255).astype(np.uint8)
+
+
+def max_diff(out, ref):
+    return np.abs(out.astype(int) - np.asarray(ref).astype(int)).max()
+
+
+def remap(img, map_x, map_y):
+    return cv2.remap(img, map_x, map_y, cv2.INTER_LINEAR, borderMode=cv2.BORDER_CONSTANT)
+
+
+def optical_distortion(img, k):
+    """albumentations' OpticalDistortion with dx = dy = 0"""
+    h, w = img.shape[:2]
+    camera = np.array([[w, 0, w / 2], [0, h, h / 2], [0, 0, 1]], dtype=np.float32)
+    distortion = np.array([k, k, 0, 0, 0], dtype=np.float32)
+    map_x, map_y = cv2.initUndistortRectifyMap(camera, distortion, None, None, (w, h), cv2.CV_32FC1)
+    return remap(img, map_x, map_y)
+
+
+def grid_distortion(img, xsteps, ysteps):
+    """albumentations' GridDistortion without step normalization"""
+    def table(n, steps):
+        step = n // NUM_STEPS
+        t = np.zeros(n, np.float32)
+        prev = 0.
+        for idx, s in enumerate(steps):
+            start = idx * step
+            end = min(start + step, n)
+            cur = prev + step * s
+            t[start:end] = np.linspace(prev, cur, end - start)
+            prev = cur
+        return t
+
+    h, w = img.shape[:2]
+    map_x, map_y = np.meshgrid(table(w, xsteps), table(h, ysteps))
+    return remap(img, map_x, map_y)
+
+
+def shift_scale_rotate(img, angle, scale, dx, dy):
+    h, w = img.shape[:2]
+    matrix = cv2.getRotationMatrix2D((w / 2, h / 2), angle, scale)
+    matrix[0, 2] += dx * w
+    matrix[1, 2] += dy * h
+    return cv2.warpAffine(img, matrix, (w, h), flags=cv2.INTER_LINEAR, borderMode=cv2.BORDER_CONSTANT)
+
+
+def test_flip(batch):
+    rng = np.random.RandomState(1)
+    perm = np.array([[1, 0], [0, 1]] * (B // 2))
+    vflip, hflip = rng.rand(2, B) < 0.5
+    k = rng.randint(4, size=B)
+    out = BatchTransform.flip(batch, perm, vflip, hflip, k)
+    for i in range(B):
+        img = batch[i][..., perm[i]]
+        img = img[::-1] if vflip[i] else img
+        img = img[:, ::-1] if hflip[i] else img
+        assert (out[i] == np.rot90(img, k[i])).all()
+
+
+def test_gamma(batch):
+    gamma = np.random.RandomState(2).uniform(0.9, 3.5, B)
+    gamma[0] = 1
+    out = BatchTransform.gamma(batch, gamma)
+    ref = [RandomGamma(p=1).apply(img, gamma=g) for img, g in zip(batch, gamma)]
+    assert max_diff(out, ref) <= GAMMA_TOL
+
+
+def warp(batch, distortion=None, xsteps=None, ysteps=None, angle=None, scale=None, dx=None, dy=None):
+    zeros = np.zeros(B)
+    no_grid = np.full((B, NUM_STEPS + 1), np.nan)
+    return BatchTransform(num_steps=NUM_STEPS).warp(
+        batch, np.full(B, np.nan) if distortion is None else distortion,
+        no_grid if xsteps is None else xsteps, no_grid if ysteps is None else ysteps,
+        zeros if angle is None else angle, np.ones(B) if scale is None else scale,
+        zeros if dx is None else dx, zeros if dy is None else dy)
+
+
+def test_optical_distortion(batch):
+    k = np.random.RandomState(3).uniform(-0.05, 0.05, B)
+    out = warp(batch, distortion=k)
+    ref = [optical_distortion(img, ki) for img, ki in zip(batch, k)]
+    assert max_diff(out, ref) <= OPTICAL_TOL
+
+
+def test_grid_distortion(batch):
+    xsteps, ysteps = 1 + np.random.RandomState(4).uniform(-0.3, 0.3, (2, B, NUM_STEPS + 1))
+    out = warp(batch, xsteps=xsteps, ysteps=ysteps)
+    ref = [grid_distortion(img, xs, ys) for img, xs, ys in zip(batch, xsteps, ysteps)]
+    assert max_diff(out, ref) <= GRID_TOL
+
+
+def test_shift_scale_rotate(batch):
+    rng = np.random.RandomState(5)
+    angle = rng.uniform(-45, 45, B)
+    scale = rng.uniform(0.8, 1.2, B)
+    dx, dy = rng.uniform(-0.0625, 0.0625, (2, B))
+    out = warp(batch, angle=angle, scale=scale, dx=dx, dy=dy)
+    ref = [shift_scale_rotate(*args) for args in zip(batch, angle, scale, dx, dy)]
+    assert max_diff(out, ref) <= RIM_TOL
+    frame = np.stack([shift_scale_rotate(np.ones((H, W), np.uint8), *args)
+                      for args in zip(angle, scale, dx, dy)])
+    inner = np.stack([cv2.erode(f, np.ones((3, 3), np.uint8), borderValue=0) for f in frame]).astype(bool)
+    assert max_diff(out[inner], np.stack(ref)[inner]) <= SSR_TOL
+
+
+def test_batch_matches_per_sample_shape(batch):
+    out = BatchTransform()(batch)
+    ref = BatchTransform(per_sample=True)(batch)
+    assert out.shape == ref.shape == batch.shape
+    assert out.dtype == ref.dtype == batch.dtype
@@ -1,27 +1,33 @@
-from colocalization.datagen import Iterator, train_transform
+from colocalization.datagen import Iterator, train_batch_transform
 from colocalization.models import xception
 import numpy as np
 import pandas as pd
 from pathlib import Path
 from keras.callbacks import ModelCheckpoint, CSVLogger, LearningRateScheduler
 from colocalization.utils import train_test_split
+from colocalization.image_store import ImageStore
+from colocalization.loader import ProcessLoader
+from colocalization.folds import run_folds
 from model_utils import get_scheduler
+import argparse
 
 
 DATA_DIR = Path('Data')
 DATA_DF = pd.read_csv(DATA_DIR / 'coloc_gs_.csv')
 
 CROP_SZ = 128
+STORE_DIR = Path('Store')    # images packed by image_store.py, used if present
+STORE = ImageStore(STORE_DIR, CROP_SZ) if ImageStore.exists(STORE_DIR, CROP_SZ) else None
 FOLD = 5
 N_FOLDS = 5
 
 MODEL = xception
 BATCH_SIZE = 16
 VERBOSE = False
+WORKERS = 3     # batch building processes
+PREFETCH = 2    # batches in flight per worker
 INIT_WEIGHTS = None
 # INIT_WEIGHTS = 'checkpoints/checkpoint.xception.sz128.fold5-5.31-0.06.hdf5'
-MODEL_CHECKPOINT = f'checkpoints/checkpoint.{MODEL.__name__}.sz{CROP_SZ}.fold{FOLD}-{N_FOLDS}.{{epoch:02d}}-{{val_mean_squared_error:.2f}}.hdf5'
-CSV_LOGGER = CSVLogger(f'logs/{MODEL.__name__}.sz{CROP_SZ}.log', append=True)
 
 LR = 1e-4
 OPTIMIZER = 'adam'
@@ -31,35 +37,49 @@ LR_STEPS = {0: 1e-3, 10: 1e-4, 100: 5e-5}
 scheduler = get_scheduler(LR_STEPS)
 
 
+def model_checkpoint(test_fold, n_folds):
+    return f'checkpoints/checkpoint.{MODEL.__name__}.sz{CROP_SZ}.fold{test_fold}-{n_folds}.{{epoch:02d}}-{{val_mean_squared_error:.2f}}.hdf5'
+
+
 def train(test_fold, n_folds):
     train_df, test_df = train_test_split(DATA_DF, test_fold=test_fold, n_folds=n_folds)
-    model = MODEL(lr=LR, weights=INIT_WEIGHTS, optimizer=OPTIMIZER)
+    model = MODEL(lr=LR, weights=INIT_WEIGHTS, optimizer=OPTIMIZER, input_scaling=True)
 
-    train_iterator = Iterator(DATA_DIR, train_df, CROP_SZ, augment=train_transform(), target_noise=0.05,
+    train_iterator = Iterator(DATA_DIR, train_df, CROP_SZ, augment=train_batch_transform(), target_noise=0.05,
                               shuffle=True, seed=None, infinite_loop=True, batch_size=BATCH_SIZE,
-                              verbose=VERBOSE, gen_id='train', output_fname=False)
+                              verbose=VERBOSE, gen_id='train', output_fname=False, store=STORE, uint8_output=True)
     val_iterator = Iterator(DATA_DIR, test_df, CROP_SZ, augment=None, target_noise=0.0,
                             shuffle=False, seed=None, infinite_loop=False, batch_size=BATCH_SIZE,
-                            verbose=VERBOSE, gen_id='val', output_fname=False)
+                            verbose=VERBOSE, gen_id='val', output_fname=False, store=STORE,
+                            uint8_output=True)
 
     x, y = zip(*val_iterator)
     x = np.concatenate(x)
     y = np.concatenate(y)
     validation_data = x, y
     callbacks = [
-        ModelCheckpoint(MODEL_CHECKPOINT, monitor='val_mean_squared_error', save_best_only=True),
-        CSV_LOGGER,
+        ModelCheckpoint(model_checkpoint(test_fold, n_folds), monitor='val_mean_squared_error', save_best_only=True),
+        CSVLogger(f'logs/{MODEL.__name__}.sz{CROP_SZ}.fold{test_fold}-{n_folds}.log', append=True),
         LearningRateScheduler(scheduler)
     ]
+    train_loader = ProcessLoader(train_iterator, workers=WORKERS, prefetch=PREFETCH)
     model.fit_generator(
-        train_iterator,
+        train_loader,
         steps_per_epoch=len(train_df) // BATCH_SIZE,
         epochs=EPOCHS,
         validation_data=validation_data,
-        workers=3,
+        workers=0,
         callbacks=callbacks
     )
+    train_loader.close()
 
 
 if __name__ == '__main__':
-    train(test_fold=FOLD, n_folds=N_FOLDS)
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-folds', type=int, nargs='+', default=[FOLD], help='test folds, a model is trained for each')
+    parser.add_argument('-workers', type=int, default=1,
+                        help='folds trained in parallel processes, pinned to their share of CPUs, 0: in this process')
+    args = parser.parse_args()
+    # a trained fold is marked by a part in checkpoints/, later runs skip it
+    tasks = [(f'fold{fold}-{N_FOLDS}', (fold, N_FOLDS)) for fold in args.folds]
+    run_folds(train, tasks, 'checkpoints', f'train.{MODEL.__name__}.sz{CROP_SZ}', args.workers)
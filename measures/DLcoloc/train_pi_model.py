@@ -5,7 +5,11 @@ import pandas as pd
 from pathlib import Path
 from keras.callbacks import CSVLogger, LearningRateScheduler
 from colocalization.utils import train_test_split
+from colocalization.image_store import ImageStore
+from colocalization.loader import ProcessLoader
+from colocalization.folds import run_folds
 from model_utils import get_scheduler
+import argparse
 
 
 DATA_DIR = Path('Data')
@@ -14,15 +18,17 @@ DATA_DIR_UNSUP = Path('DataUnsupervised')
 DATA_DF_UNSUP = pd.read_csv(DATA_DIR_UNSUP / 'coloc_gs_unsup.csv')
 
 CROP_SZ = 128
+STORE_DIR = Path('Store')    # images packed by image_store.py, used if present
+STORE = ImageStore(STORE_DIR, CROP_SZ) if ImageStore.exists(STORE_DIR, CROP_SZ) else None
 FOLD = 5
 N_FOLDS = 5
 
 MODEL = pi_model
 BATCH_SIZE = 16
 VERBOSE = False
+WORKERS = 3     # batch building processes
+PREFETCH = 2    # batches in flight per worker
 INIT_WEIGHTS = 'checkpoints/checkpoint.pi_model.sz128.fold5-5.05-0.05.hdf5'
-MODEL_CHECKPOINT = f'checkpoints/checkpoint.{MODEL.__name__}.sz{CROP_SZ}.fold{FOLD}-{N_FOLDS}.{{epoch:02d}}-{{val_out1_loss:.2f}}.hdf5'
-CSV_LOGGER = CSVLogger(f'logs/{MODEL.__name__}.sz{CROP_SZ}.log', append=True)
 
 LR = 1e-4
 OPTIMIZER = 'adam'
@@ -34,20 +40,25 @@ scheduler = get_scheduler(LR_STEPS)
 LOSS_WEIGHTS = (0.5, 10.0)   # supervised/unsupervised
 
 
+def model_checkpoint(test_fold, n_folds):
+    return f'checkpoints/checkpoint.{MODEL.__name__}.sz{CROP_SZ}.fold{test_fold}-{n_folds}.{{epoch:02d}}-{{val_out1_loss:.2f}}.hdf5'
+
+
 def train(test_fold, n_folds):
     train_df, test_df = train_test_split(DATA_DF, test_fold=test_fold, n_folds=n_folds)
-    model = MODEL(lr=LR, weights=INIT_WEIGHTS, optimizer=OPTIMIZER, loss_weights=LOSS_WEIGHTS)
+    model = MODEL(lr=LR, weights=INIT_WEIGHTS, optimizer=OPTIMIZER, loss_weights=LOSS_WEIGHTS, input_scaling=True)
     train_iterator = IteratorPi(sup_data_dir=DATA_DIR, unsup_data_dir=DATA_DIR_UNSUP,
                                 sup_df=train_df, unsup_df=DATA_DF_UNSUP,
                                 crop_sz=CROP_SZ, #augment=train_transform(),
                                 target_noise=0.0,
                                 shuffle=True, seed=None, infinite_loop=True, batch_size=BATCH_SIZE,
-                                verbose=VERBOSE, gen_id='train', output_fname=False)
+                                verbose=VERBOSE, gen_id='train', output_fname=False, store=STORE, uint8_output=True)
     val_iterator = IteratorPi(sup_data_dir=DATA_DIR, unsup_data_dir=DATA_DIR,
                               sup_df=test_df, unsup_df=test_df,
                               crop_sz=CROP_SZ, target_noise=0.0,
                               shuffle=False, seed=None, infinite_loop=False, batch_size=BATCH_SIZE,
-                              verbose=VERBOSE, gen_id='val', output_fname=False)
+                              verbose=VERBOSE, gen_id='val', output_fname=False, store=STORE,
+                              uint8_output=True)
 
     x, y, w = zip(*val_iterator)
     x = [np.concatenate(_x) for _x in zip(*x)]
@@ -55,20 +66,29 @@ def train(test_fold, n_folds):
     w = [np.concatenate(_w) for _w in zip(*w)]
     validation_data = x, y, w
     callbacks = [
-        ModelCheckpoint(MODEL_CHECKPOINT, monitor='val_out1_loss',
+        ModelCheckpoint(model_checkpoint(test_fold, n_folds), monitor='val_out1_loss',
                         save_best_only=True),
-        CSV_LOGGER,
+        CSVLogger(f'logs/{MODEL.__name__}.sz{CROP_SZ}.fold{test_fold}-{n_folds}.log', append=True),
         LearningRateScheduler(scheduler)
     ]
+    train_loader = ProcessLoader(train_iterator, workers=WORKERS, prefetch=PREFETCH)
     model.fit_generator(
-        train_iterator,
+        train_loader,
         steps_per_epoch=len(train_df) // BATCH_SIZE,
         epochs=EPOCHS,
         validation_data=validation_data,
-        workers=3,
+        workers=0,
         callbacks=callbacks
     )
+    train_loader.close()
 
 
 if __name__ == '__main__':
-    train(test_fold=FOLD, n_folds=N_FOLDS)
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-folds', type=int, nargs='+', default=[FOLD], help='test folds, a model is trained for each')
+    parser.add_argument('-workers', type=int, default=1,
+                        help='folds trained in parallel processes, pinned to their share of CPUs, 0: in this process')
+    args = parser.parse_args()
+    # a trained fold is marked by a part in checkpoints/, later runs skip it
+    tasks = [(f'fold{fold}-{N_FOLDS}', (fold, N_FOLDS)) for fold in args.folds]
+    run_folds(train, tasks, 'checkpoints', f'train.{MODEL.__name__}.sz{CROP_SZ}', args.workers)
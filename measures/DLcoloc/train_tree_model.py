@@ -1,9 +1,12 @@
 import pandas as pd
 import numpy as np
-from scipy.stats import spearmanr, kendalltau, pearsonr
-import pickle
+from scipy.stats import kendalltau, pearsonr
 from pathlib import Path
-from utils import train_test_split
+from concurrent.futures import ThreadPoolExecutor
+from utils import train_test_split, ion_names
+from scoring import spearman_correlation
+from feature_store import open_feature_store
+from folds import part_path, save_part, load_part, merge_parts, inputs_key
 import lightgbm as lgb
 from stats import accuracy
 import os
@@ -35,72 +38,78 @@ PARAM = {
     'feature_fraction_seed': 0,
     'bagging_seed': 0,
 }
+LOG_PERIOD = 100    # rounds between evaluation prints, folds train concurrently
 
 
-def load_data(feature_dict_path, df, test_fold, n_folds):
-    def _comb_features(base_f, other_f):
-        return np.concatenate([
+def pair_features(feature_store, df):
+    """(features, targets) of all pairs of `df`: base and other features, their squared difference
+    and Spearman correlation, one row per pair"""
+    datasetIds = df['datasetId'].values
+    base_f = feature_store.get(datasetIds, ion_names(df['baseSf'], df['baseAdduct']).values)
+    other_f = feature_store.get(datasetIds, ion_names(df['otherSf'], df['otherAdduct']).values)
+    with np.errstate(invalid='ignore'):
+        features = np.concatenate([
             base_f,
             other_f,
             np.square(base_f - other_f),
-            [spearmanr(base_f, other_f)[0]],
-            # [np.square(base_f - other_f).sum()],
-            # [pearsonr(base_f, other_f)[0]],
-        ])
-
-    def _get_features(_df, feature_dict):
-        features = []
-        y = []
-        for _, row in _df.iterrows():
-            datasetId, baseSf, baseAdduct, otherSf, otherAdduct, rank = row
-            base_ion = '.'.join((baseSf, baseAdduct.replace('+', 'p').replace('-', 'm')))
-            other_ion = '.'.join((otherSf, otherAdduct.replace('+', 'p').replace('-', 'm')))
-            base_img = '.'.join((datasetId, base_ion))
-            other_img = '.'.join((datasetId, other_ion))
-
-            base_features = feature_dict[next(key for key in feature_dict.keys() if base_img in key)]
-            other_features = feature_dict[next(key for key in feature_dict.keys() if other_img in key)]
-            features.append(_comb_features(base_features, other_features))
-            y.append(rank / 10.)
-        return np.array(features), np.array(y)
-
-    train_df, test_df = train_test_split(df, test_fold=test_fold, n_folds=n_folds)
-    with open(feature_dict_path, 'rb') as f:
-        feature_dict = pickle.load(f)
-
-    return _get_features(train_df, feature_dict), _get_features(test_df, feature_dict), test_df.index
-
-
-def train(x_train: np.array, y_train: np.array, x_val: np.array, y_val: np.array, save_path=None):
-
-    train_data = lgb.Dataset(x_train, label=y_train)
-    val_data = lgb.Dataset(x_val, label=y_val)
-    gbm = lgb.train(PARAM, train_data, NUM_ROUND, valid_sets=[train_data, val_data], verbose_eval=True)
-    pred = gbm.predict(x_val)
-
-    accuracy(y_val, pred)
+            spearman_correlation(base_f, other_f)[:, None],
+            # np.square(base_f - other_f).sum(axis=1, keepdims=True),
+            # correlation(base_f, other_f)[:, None],
+        ], axis=1)
+    return features, df['rank'].values / 10.
+
+
+def train(train_data: lgb.Dataset, val_data: lgb.Dataset, x_val: np.array, num_threads=0):
+    param = dict(PARAM, num_threads=num_threads)
+    gbm = lgb.train(param, train_data, NUM_ROUND, valid_sets=[train_data, val_data],
+                    callbacks=[lgb.log_evaluation(LOG_PERIOD)])
+    pred = gbm.predict(x_val, num_threads=num_threads)
+
+    accuracy(val_data.get_label(), pred)
     return pred
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('-features', default=None, required=False, help='path to unsupervised features')
+    parser.add_argument('-threads', type=int, default=os.cpu_count(),
+                        help='LightGBM threads, split between the folds trained at the same time')
     args = parser.parse_args()
     MODEL_TYPE = 'gbt'
 
     MODEL_DIR = Path(CURRENT_DIR / 'models/unsupervised_model')
-    FEATURE_DICT_PATH = Path(args.features) if args.features else MODEL_DIR / 'features.ncomp20.naugs40.pkl'
+    FEATURES_PATH = Path(args.features) if args.features else MODEL_DIR / 'features.ncomp20.naugs40.pkl'
     PREDS_DF_PATH = PREDS_DIR / 'preds_{}.csv'.format(MODEL_TYPE)
 
-    PREDS_DF = DATA_DF.copy()
+    # a pickled feature dict is converted to a feature store beside it on first use
+    FEATURE_STORE = open_feature_store(FEATURES_PATH)
+    # predictions of each fold are saved as a part, named by the feature store,
+    # folds with a part of the same features are not trained again
+    PARTS_NAME = f'preds_{MODEL_TYPE}.{inputs_key(FEATURE_STORE.features_path, FEATURE_STORE.index_path)}'
+    PART_PATHS = {fold: part_path(PREDS_DIR / 'parts', PARTS_NAME, f'fold{fold}-{N_FOLDS}') for fold in FOLDS}
+    todo = [fold for fold in FOLDS if not PART_PATHS[fold].exists()]
+
+    # features of all pairs, binned once, each fold trains and validates on subsets of the same dataset
+    features, y = pair_features(FEATURE_STORE, DATA_DF)
+    full_data = lgb.Dataset(features, label=y, params=PARAM, free_raw_data=False).construct()
+    fold_data = {}
     for fold in FOLDS:
+        train_df, test_df = train_test_split(DATA_DF, test_fold=fold, n_folds=N_FOLDS)
+        train_i, test_i = DATA_DF.index.get_indexer(train_df.index), DATA_DF.index.get_indexer(test_df.index)
+        assert len(train_i) + len(test_i) == len(DATA_DF)
+        fold_data[fold] = full_data.subset(train_i), full_data.subset(test_i), features[test_i], test_df.index
+
+    n_parallel = max(1, min(len(todo), args.threads))
+
+    def _train_fold(fold):
         print(f'Fold {fold}/{len(FOLDS)}')
-        (train_features, train_y), (test_features, test_y), df_index = load_data(FEATURE_DICT_PATH, DATA_DF,
-                                                                                 fold, N_FOLDS)
-        assert len(train_features) + len(test_features) == len(DATA_DF)
+        train_data, val_data, x_val, _ = fold_data[fold]
+        return train(train_data, val_data, x_val, num_threads=max(1, args.threads // n_parallel))
 
-        pred = train(train_features, train_y, test_features, test_y)
-        PREDS_DF.loc[df_index, 'pred'] = pred * 10
+    with ThreadPoolExecutor(n_parallel) as executor:
+        for fold, pred in zip(todo, executor.map(_train_fold, todo)):
+            save_part(PART_PATHS[fold], pd.DataFrame({'pred': pred * 10}, index=fold_data[fold][3]))
 
+    PREDS_DF = merge_parts(DATA_DF, {fold: load_part(path) for fold, path in PART_PATHS.items()})
     PREDS_DF.to_csv(PREDS_DF_PATH, index=False)
     accuracy(DATA_DF['rank'], PREDS_DF['pred'])
@@ -1,15 +1,16 @@
-import umap
 import pandas as pd
 import numpy as np
 import numba
-from scipy.stats import spearmanr, kendalltau, pearsonr
+from scipy.stats import spearmanr, kendalltau
 import cv2
 from pathlib import Path
 from scipy.stats import spearmanr
 from itertools import product, chain
-import pickle
 import os
 import argparse
+from scoring import correlation
+from umap_ensemble import UmapEnsemble
+from feature_store import FeatureStore
 
 
 @numba.njit()
@@ -42,13 +43,13 @@ CROP_SZ = 96
 
 METRICS = ['correlation', 'cosine']
 RANDOM_STATES = range(20)
-UMAP_SETTINGS = product(METRICS, RANDOM_STATES)
+UMAP_SETTINGS = list(product(METRICS, RANDOM_STATES))
 naugs = len(RANDOM_STATES) * len(METRICS)
 
 
 def dist(a):
     """calculate distances a[0]<->a[1:]"""
-    return np.array([-pearsonr(a[0], x)[0] for x in a[1:]])
+    return -correlation(a[0], a[1:])
 
 
 def preprocess(img, crop_sz):
@@ -70,6 +71,7 @@ if __name__ == '__main__':
     parser.add_argument('data_dir', default=None, help='path to gold standard images')
     parser.add_argument('-aux_dir', default='', help='path to auxiliary images')
     parser.add_argument('-dump_features', action='store_true', help='dump features')
+    parser.add_argument('-processes', type=int, default=None, help='U-map settings fitted in parallel')
     args = parser.parse_args()
     DATA_DIR = Path(args.data_dir)
     AUX_IMAGES = list(Path(args.aux_dir).glob('*.tif'))
@@ -80,8 +82,10 @@ if __name__ == '__main__':
     PREDS_DF = PREDS_DIR / 'preds_{}.csv'.format(MODEL_TYPE)
 
     Path.mkdir(MODEL_DIR, exist_ok=True)
-    FEATURE_DICT = MODEL_DIR / f'features.ncomp{N_COMPONENTS}.crop{CROP_SZ}.naugs{naugs}'\
-        f'{".aux" if len(AUX_IMAGES) > 0 else ""}.pkl'
+    FEATURE_STORE = MODEL_DIR / f'features.ncomp{N_COMPONENTS}.crop{CROP_SZ}.naugs{naugs}'\
+        f'{".aux" if len(AUX_IMAGES) > 0 else ""}'
+    ENSEMBLE_DIR = MODEL_DIR / f'umap_ensemble.ncomp{N_COMPONENTS}.crop{CROP_SZ}.naugs{naugs}'\
+        f'{".aux" if len(AUX_IMAGES) > 0 else ""}'
 
     image_paths = []
     for g in DATA_DF.groupby(['datasetId', 'baseSf']):
@@ -102,19 +106,16 @@ if __name__ == '__main__':
 
     data = np.stack([d.flatten() for d in image_list])
 
-    embedding_stated = []
-    for i, setting in enumerate(UMAP_SETTINGS):
-        metric, rs = setting
-        print(f'U-Map: metric \'{metric}\', random state {rs}, {i + 1}/{naugs}')
-        embd = umap.UMAP(metric=metric, n_neighbors=N_NEIGHBORS, min_dist=MIN_DIST,
-                         n_components=N_COMPONENTS, random_state=rs).fit_transform(data)
-        embedding_stated.append(embd)
+    # one kNN graph per metric, shared by its random states
+    ensemble = UmapEnsemble(UMAP_SETTINGS, N_NEIGHBORS, MIN_DIST, N_COMPONENTS, params=dict(crop_sz=CROP_SZ))
+    embedding_stated = ensemble.fit_transform(data, processes=args.processes, knn_dir=MODEL_DIR / 'knn')
+    print('Saving U-map ensemble to', ENSEMBLE_DIR)
+    ensemble.save(ENSEMBLE_DIR)
 
     if DUMP_FEATURES:
         feature_dict = dict(zip(map(str, image_paths), np.concatenate(embedding_stated, axis=-1)))
-        print('Dumping features to', FEATURE_DICT)
-        with open(FEATURE_DICT, 'wb') as f:
-            pickle.dump(feature_dict, f)
+        print('Dumping features to', FEATURE_STORE)
+        FeatureStore.from_feature_dict(feature_dict, FEATURE_STORE).save()
 
     mean_acc = []
     pred_ranks_all = []
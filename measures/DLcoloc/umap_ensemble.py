@@ -0,0 +1,305 @@
+import os
+import argparse
+import copy
+import hashlib
+import pickle
+import warnings
+import multiprocessing as mp
+from multiprocessing import shared_memory
+from pathlib import Path
+import numpy as np
+import pandas as pd
+from scoring import normalize_rows
+from image_store import parse_image_name
+from feature_store import open_feature_store
+
+
+SMALL_DATA = 4096   # below, U-map computes exact distances itself, so does `knn_graph`
+BLOCK_SIZE = 1024   # rows of the exact distance matrix computed at a time
+KNN_FNAME = 'knn.{}.k{}.{}.npz'
+INDEX_FNAME = 'knn.{}.k{}.{}.index.pkl'
+SHARED_ATTRS = ('_raw_data', 'precomputed_knn', 'knn_indices', '_knn_indices', 'knn_dists', '_knn_dists',
+                'knn_search_index', '_knn_search_index', 'graph_')    # the same for all random states of a metric
+ENSEMBLE_FNAME = 'ensemble.pkl'
+DATA_FNAME = 'data.npy'
+SHARED_FNAME = 'shared.{}.pkl'
+
+
+def data_hash(data):
+    return hashlib.sha1(np.ascontiguousarray(data).view(np.uint8)).hexdigest()[:16]
+
+
+def exact_knn(data, n_neighbors, metric, block_size=BLOCK_SIZE):
+    """(indices, distances) of the n_neighbors nearest rows of each row, itself first at distance 0,
+    for the 'correlation' and 'cosine' distances of U-map"""
+    x = normalize_rows(data, center=metric == 'correlation')
+    n = len(x)
+    indices = np.zeros((n, n_neighbors), dtype=np.int64)
+    distances = np.zeros((n, n_neighbors), dtype=np.float32)
+    for start in range(0, n, block_size):
+        stop = min(start + block_size, n)
+        d = np.clip(1 - x[start: stop] @ x.T, 0, 2)
+        d[np.arange(stop - start), np.arange(start, stop)] = 0
+        top = np.argpartition(d, n_neighbors - 1, axis=1)[:, :n_neighbors]
+        top_d = np.take_along_axis(d, top, axis=1)
+        order = np.argsort(top_d, axis=1, kind='stable')
+        indices[start: stop] = np.take_along_axis(top, order, axis=1)
+        distances[start: stop] = np.take_along_axis(top_d, order, axis=1)
+    return indices, distances
+
+
+def knn_graph(data, n_neighbors, metric, exact=None, random_state=0):
+    """(indices, distances, search index or None) of the kNN graph of `data`, as U-map builds it:
+    exact for fewer than SMALL_DATA rows unless `exact` says otherwise, else by nearest neighbour descent"""
+    if exact is None:
+        exact = len(data) < SMALL_DATA
+    if exact:
+        return (*exact_knn(data, n_neighbors, metric), None)
+    from umap.umap_ import nearest_neighbors
+    return nearest_neighbors(data, n_neighbors, metric, {}, False, np.random.RandomState(random_state),
+                             low_memory=True, use_pynndescent=True, n_jobs=-1)
+
+
+def read_images(image_paths, crop_sz):
+    """(n_images, n_pixels) matrix of grayscale images resized as in train_unsupervised_model.py"""
+    import cv2
+    images = [cv2.imread(str(p), cv2.IMREAD_GRAYSCALE) for p in image_paths]
+    if crop_sz is not None:
+        images = [cv2.resize(img, dsize=(crop_sz, crop_sz), interpolation=cv2.INTER_CUBIC) for img in images]
+    return np.stack([img.flatten() for img in images])
+
+
+def split_reducer(reducer):
+    """(copy of a fitted reducer without the attributes shared by its metric, shared attributes)"""
+    stripped = copy.copy(reducer)
+    shared = {a: stripped.__dict__.pop(a) for a in SHARED_ATTRS if a in stripped.__dict__}
+    return stripped, shared
+
+
+def join_reducer(reducer, shared, data):
+    for a, v in shared.items():
+        setattr(reducer, a, v)
+    reducer._raw_data = data
+    return reducer
+
+
+_shared = None
+
+
+def _init_worker(shm_specs, state):
+    global _shared
+    shms, arrays = [], []
+    for name, shape, dtype in shm_specs:
+        shms.append(shared_memory.SharedMemory(name=name))
+        arrays.append(np.ndarray(shape, dtype=dtype, buffer=shms[-1].buf))
+    _shared = shms, arrays, state
+
+
+def _fit_setting(task):
+    """Fitted reducer without shared attributes, and the shared attributes for the first setting of a metric"""
+    import umap
+    _, (data, ), (graphs, umap_args) = _shared
+    (metric, rs), first = task
+    indices, distances, search_index = graphs[metric]
+    with warnings.catch_warnings():
+        # no search index for exact graphs, they are transformed exactly, see below
+        warnings.filterwarnings('ignore', message=r'precomputed_knn\[2\]')
+        # U-map marks disconnected neighbours in place, every seed gets its own copy
+        reducer = umap.UMAP(metric=metric, random_state=rs, force_approximation_algorithm=True,
+                            precomputed_knn=(indices.copy(), distances.copy(), search_index), **umap_args)
+        reducer.fit(data)
+    if search_index is None:
+        # new images are compared to all training images, as U-map does for small data
+        reducer._small_data = True
+        del reducer._knn_search_index
+    reducer, shared = split_reducer(reducer)
+    shared.pop('_raw_data')
+    return reducer, shared if first else None
+
+
+def _transform_setting(i):
+    _, (data, raw_data), (reducers, metrics, shared) = _shared
+    return join_reducer(copy.copy(reducers[i]), shared[metrics[i]], raw_data).transform(data)
+
+
+def _map(fun, tasks, arrays, state, processes, progress=None):
+    """fun(task) for each task, in `processes` workers seeing `arrays` in shared memory and `state`"""
+    processes = min(processes or os.cpu_count(), len(tasks))
+    shms = []
+    try:
+        for x in arrays:
+            shms.append(shared_memory.SharedMemory(create=True, size=max(x.nbytes, 1)))
+            np.ndarray(x.shape, dtype=x.dtype, buffer=shms[-1].buf)[:] = x
+        initargs = ([(shm.name, x.shape, x.dtype) for shm, x in zip(shms, arrays)], state)
+        results = []
+        if processes > 1:
+            # not forked from this process: numba's threading layer may be running in it and doesn't survive
+            # a fork, the process would hang at exit
+            ctx = mp.get_context('forkserver') if 'forkserver' in mp.get_all_start_methods() \
+                else mp.get_context('spawn')
+            with ctx.Pool(processes, initializer=_init_worker, initargs=initargs) as pool:
+                for i, result in enumerate(pool.imap(fun, tasks)):
+                    results.append(result)
+                    if progress:
+                        progress(i)
+        else:
+            _init_worker(*initargs)
+            for i, task in enumerate(tasks):
+                results.append(fun(task))
+                if progress:
+                    progress(i)
+    finally:
+        global _shared
+        _shared = None
+        for shm in shms:
+            shm.close()
+            shm.unlink()
+    return results
+
+
+class UmapEnsemble(object):
+    """U-map embeddings of the same images for several (metric, random state) settings.
+
+    The kNN graph only depends on the metric, so it is built once per metric (`knn_graph`),
+    saved in `knn_dir` when given and reused by every random state of the metric, which only
+    optimizes the layout. Settings are fitted in `processes` worker processes over one
+    shared-memory copy of the data.
+
+    Fitted reducers are kept in `reducers`, `save` / `load` persist them with the preprocessing
+    `params` (e.g. crop size), the training data and the graphs once per metric, and `transform`
+    embeds new images into the fitted spaces without changing the training embeddings.
+    """
+
+    def __init__(self, settings, n_neighbors, min_dist, n_components, exact_knn=None, params=None):
+        self.settings = list(settings)
+        self.n_neighbors = n_neighbors
+        self.min_dist = min_dist
+        self.n_components = n_components
+        self.exact_knn = exact_knn
+        self.params = dict(params or {})
+        self.reducers = None
+
+    def graph(self, data, metric, knn_dir=None):
+        if knn_dir is None:
+            return knn_graph(data, self.n_neighbors, metric, self.exact_knn)
+        knn_dir = Path(knn_dir)
+        key = (metric, self.n_neighbors, data_hash(data))
+        knn_path, index_path = knn_dir / KNN_FNAME.format(*key), knn_dir / INDEX_FNAME.format(*key)
+        if knn_path.exists():
+            arrays = np.load(knn_path)
+            search_index = None
+            if index_path.exists():
+                with open(index_path, 'rb') as f:
+                    search_index = pickle.load(f)
+            return arrays['indices'], arrays['distances'], search_index
+        indices, distances, search_index = knn_graph(data, self.n_neighbors, metric, self.exact_knn)
+        Path.mkdir(knn_dir, parents=True, exist_ok=True)
+        if search_index is not None:
+            with open(index_path, 'wb') as f:
+                pickle.dump(search_index, f)
+        # the graph is written last, an interrupted save is recomputed
+        np.savez(knn_path, indices=indices, distances=distances)
+        return indices, distances, search_index
+
+    def _progress(self, action, verbose):
+        def progress(i):
+            if verbose:
+                metric, rs = self.settings[i]
+                print(f'U-Map{action}: metric \'{metric}\', random state {rs}, {i + 1}/{len(self.settings)}')
+        return progress
+
+    def fit_transform(self, data, processes=None, knn_dir=None, verbose=True):
+        """Embeddings of `data`, one (n, n_components) array per setting"""
+        graphs = {}
+        for metric in dict.fromkeys(metric for metric, _ in self.settings):
+            if verbose:
+                print(f'kNN graph: metric \'{metric}\', {self.n_neighbors} neighbours of {len(data)} images')
+            graphs[metric] = self.graph(data, metric, knn_dir)
+
+        # seeded U-map runs single-threaded anyway, parallelism is across settings
+        umap_args = dict(n_neighbors=self.n_neighbors, min_dist=self.min_dist, n_components=self.n_components,
+                         n_jobs=1)
+        metrics = [metric for metric, _ in self.settings]
+        tasks = [(setting, metrics.index(setting[0]) == i) for i, setting in enumerate(self.settings)]
+        fitted = _map(_fit_setting, tasks, [data], (graphs, umap_args), processes, self._progress('', verbose))
+
+        raw_data = np.asarray(data, dtype=np.float32)
+        shared = {metric: fitted[metrics.index(metric)][1] for metric in graphs}
+        self.reducers = [join_reducer(reducer, shared[metric], raw_data)
+                         for (reducer, _), (metric, _) in zip(fitted, self.settings)]
+        return [reducer.embedding_ for reducer in self.reducers]
+
+    def transform(self, data, processes=None, verbose=True):
+        """Embeddings of new images in the fitted spaces, one (n, n_components) array per setting"""
+        reducers, shared = zip(*map(split_reducer, self.reducers))
+        metrics = [metric for metric, _ in self.settings]
+        shared = {metric: {a: v for a, v in shared[metrics.index(metric)].items() if a != '_raw_data'}
+                  for metric in metrics}
+        raw_data = self.reducers[0]._raw_data
+        return _map(_transform_setting, list(range(len(reducers))), [data, raw_data], (reducers, metrics, shared),
+                    processes, self._progress(' transform', verbose))
+
+    def save(self, path):
+        path = Path(path)
+        Path.mkdir(path, parents=True, exist_ok=True)
+        reducers, shared = zip(*map(split_reducer, self.reducers))
+        data = shared[0]['_raw_data']
+        # a loaded ensemble maps its data file, saving it in place would overwrite it while mapped
+        if not (isinstance(data, np.memmap) and Path(data.filename) == (path / DATA_FNAME).resolve()):
+            np.save(path / DATA_FNAME, data)
+        metrics = [metric for metric, _ in self.settings]
+        for metric in dict.fromkeys(metrics):
+            attrs = {a: v for a, v in shared[metrics.index(metric)].items() if a != '_raw_data'}
+            with open(path / SHARED_FNAME.format(metric), 'wb') as f:
+                pickle.dump(attrs, f, protocol=pickle.HIGHEST_PROTOCOL)
+        state = dict(self.__dict__, reducers=list(reducers))
+        # written last, marks a complete ensemble
+        with open(path / ENSEMBLE_FNAME, 'wb') as f:
+            pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    @staticmethod
+    def load(path, mmap=True):
+        path = Path(path)
+        with open(path / ENSEMBLE_FNAME, 'rb') as f:
+            state = pickle.load(f)
+        ensemble = UmapEnsemble.__new__(UmapEnsemble)
+        ensemble.__dict__.update(state)
+        data = np.load(path / DATA_FNAME, mmap_mode='r' if mmap else None)
+        shared = {}
+        for metric, _ in ensemble.settings:
+            if metric not in shared:
+                with open(path / SHARED_FNAME.format(metric), 'rb') as f:
+                    shared[metric] = pickle.load(f)
+        ensemble.reducers = [join_reducer(reducer, shared[metric], data)
+                             for reducer, (metric, _) in zip(ensemble.reducers, ensemble.settings)]
+        return ensemble
+
+
+def append_features(features_path, image_paths, ensemble, processes=None):
+    """Embed the images missing from the feature store of train_unsupervised_model.py and add them.
+    Returns the paths of the added images."""
+    store = open_feature_store(features_path)
+    datasetIds, ions = (np.array(names, dtype=object) for names in zip(*map(parse_image_name, image_paths)))
+    repeated = pd.MultiIndex.from_arrays([datasetIds, ions]).duplicated()
+    new = np.flatnonzero(~store.contains(datasetIds, ions) & ~repeated)
+    if len(new) > 0:
+        new_paths = [image_paths[i] for i in new]
+        embeddings = ensemble.transform(read_images(new_paths, ensemble.params.get('crop_sz')), processes)
+        store.add(datasetIds[new], ions[new], np.concatenate(embeddings, axis=-1))
+        store.save()
+    return [image_paths[i] for i in new]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('ensemble_dir', help='U-map ensemble saved by train_unsupervised_model.py')
+    parser.add_argument('features', help='feature store dumped by train_unsupervised_model.py, new images are added')
+    parser.add_argument('images', nargs='+', help='new .tif images or directories of them')
+    parser.add_argument('-processes', type=int, default=None)
+    args = parser.parse_args()
+
+    image_paths = []
+    for p in map(Path, args.images):
+        image_paths.extend(sorted(p.glob('*.tif')) if p.is_dir() else [p])
+    new_paths = append_features(args.features, image_paths, UmapEnsemble.load(args.ensemble_dir), args.processes)
+    print(f'{len(new_paths)} new images added to {args.features}')
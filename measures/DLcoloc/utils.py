@@ -18,6 +18,38 @@ def train_test_split(df, test_fold=5, n_folds=5):
     return train_df, test_df
 
 
+def ion_names(sf, adduct):
+    """Ion names as used in image file names: 'C6H12O6', '+Na' -> 'C6H12O6.pNa'"""
+    return sf + '.' + adduct.str.replace('+', 'p', regex=False).str.replace('-', 'm', regex=False)
+
+
+def split_image_names(names):
+    """'<datasetId>.<ion>' -> datasetId, ion (object arrays)"""
+    parts = pd.Series(names).str.split('.', n=1, expand=True)
+    return parts[0].values.astype(object), parts[1].values.astype(object)
+
+
+class PairIndex(object):
+    """Gold standard pairs compiled into integer arrays.
+
+    Every distinct image gets an id, `datasetIds`/`ions` hold its name parts. `base`, `other` and `target`
+    are per pair, so a batch of pairs is gathered by fancy indexing instead of walking the frame row by row.
+    """
+
+    def __init__(self, df):
+        base_names = df['datasetId'] + '.' + ion_names(df['baseSf'], df['baseAdduct'])
+        other_names = df['datasetId'] + '.' + ion_names(df['otherSf'], df['otherAdduct'])
+        codes, names = pd.factorize(pd.concat([base_names, other_names], ignore_index=True))
+        self.datasetIds, self.ions = split_image_names(names)
+        self.base = codes[:len(df)]
+        self.other = codes[len(df):]
+        self.target = df['rank'].values.astype(np.float64)
+        self.index = df.index.values
+
+    def __len__(self):
+        return len(self.target)
+
+
 if __name__ == '__main__':
     data_df = pd.read_csv('Data/coloc_gs.csv')
     for test_fold in range(1, 6):
@@ -0,0 +1,397 @@
+import os
+from os import path
+import multiprocessing as mp
+import numpy as np
+import pandas as pd
+from scipy import ndimage, sparse
+from scipy.stats import rankdata, spearmanr, kendalltau
+from skimage.util.dtype import dtype_range
+from stack_cache import source_key, code_version
+
+# Percentile: higher values lead to skipping more pixels (from 0 to 1 - quantile, from 0 to 100 percentile)
+QUAN = 0.5
+# use tfidf modeling
+TFIDF = True
+# log of intensities
+LOG = False
+#  square root of intensities
+SQRT = False
+# hotspot removal
+HOTSPOT = False
+# median filter window size
+MED_WIN = 3
+# sparse (CSR) images for the cosine measures when at most this fraction of pixels is non-zero,
+# denser stacks are faster as dense BLAS products
+SPARSE_DENSITY = 0.05
+
+MEASURES = ['cosine', 'tfidf_cosine', 'pearson', 'spearman', 'ssim']
+
+# tissue mask: None (all pixels), 'union' (pixels of any ion) or 'tic' (TIC above MASK_TIC_FRAC of its 99th percentile)
+MASK = None
+MASK_METHODS = ('union', 'tic')
+MASK_TIC_FRAC = 0.01
+MASK_FNAME = '.mask.{}.npy'    # stored in the dataset directory
+
+# packed raw images of a dataset, hidden files in the dataset directory written by `pack_dataset`
+PACKED_STACK = '.stack.npy'
+PACKED_IONS = '.stack.csv'
+
+# part of the cache keys, cached stacks and similarities are recomputed after code changes
+CODE_VERSION = code_version(__file__)
+
+# compare_ssim(gaussian_weights=True) parameters
+SSIM_SIGMA = 1.5
+SSIM_TRUNCATE = 3.5
+SSIM_K1 = 0.01
+SSIM_K2 = 0.03
+SSIM_CHUNK = 64     # image pairs filtered at a time
+
+
+def preprocess(img, quan=QUAN, log=LOG, sqrt=SQRT, hotspot=HOTSPOT, med_win=MED_WIN):
+    if log: img = np.log(img)
+    if sqrt: img = np.sqrt(img)
+
+    # remove hot spots
+    if hotspot:
+        q = np.quantile(img, 0.99)
+        img[img > q] = q
+
+    # compute intensity threshold
+    if quan > 0:
+        q = np.quantile(img, quan)
+        img[img < q] = 0
+
+    # median filter
+    if med_win > 0:
+        img = ndimage.median_filter(img, med_win)
+    return img
+
+
+def preprocess_stack(images, quan=QUAN, log=LOG, sqrt=SQRT, hotspot=HOTSPOT, med_win=MED_WIN, inplace=False):
+    """`preprocess` of every image of a (..., H, W) stack at once: quantiles of all images in one call
+    along the image axes, median filter with a (1, med_win, med_win) footprint.
+    With `inplace` the stack is overwritten instead of copied, except by log / sqrt of integer images,
+    which give float32. Also fits the `preprocess` hook of the DLcoloc iterators, on uint8 stacks."""
+    x = images if inplace else images.copy()
+    for fun, on in ((np.log, log), (np.sqrt, sqrt)):
+        if on:
+            x = fun(x, out=x) if np.issubdtype(x.dtype, np.floating) else fun(x, dtype=np.float32)
+
+    # remove hot spots
+    if hotspot:
+        q = np.quantile(x, 0.99, axis=(-2, -1), keepdims=True)
+        np.copyto(x, q, casting='unsafe', where=x > q)
+
+    # compute intensity thresholds
+    if quan > 0:
+        q = np.quantile(x, quan, axis=(-2, -1), keepdims=True)
+        np.copyto(x, 0, where=x < q)
+
+    # median filter
+    if med_win > 0:
+        x = ndimage.median_filter(x, size=(1,) * (x.ndim - 2) + (med_win, med_win), output=x)
+    return x
+
+
+def preprocess_params(quan=QUAN, log=LOG, sqrt=SQRT, hotspot=HOTSPOT, med_win=MED_WIN):
+    """All preprocessing parameters, defaults filled in, as a key"""
+    return (('quan', quan), ('log', log), ('sqrt', sqrt), ('hotspot', hotspot), ('med_win', med_win))
+
+
+def ion_files(ds_path):
+    """Ion image files of a dataset directory, without the packed stack"""
+    return [f for f in os.listdir(ds_path) if not f.startswith('.')]
+
+
+def dataset_key(ds_path):
+    return source_key([path.join(ds_path, f) for f in ion_files(ds_path)])
+
+
+def load_dataset(ds_path, cache=None, **params):
+    """Ion images '<sf>_<adduct>.npy' of a dataset directory -> (ions [(sf, adduct), ...], preprocessed images
+    as an (n_ions, H, W) array). With a `StackCache`, preprocessed stacks are reused across runs."""
+    if cache is not None:
+        key = cache.key('stack', dataset_key(ds_path), preprocess_params(**params), CODE_VERSION)
+        return cache.get_or_compute(key, lambda: load_dataset(ds_path, **params))
+    ions, images = load_raw(ds_path)
+    # a packed stack is a read-only memory map
+    return ions, preprocess_stack(images, inplace=images.flags.writeable, **params)
+
+
+def packed_ions(ds_path):
+    """Ions of the packed stack of a dataset, None without one or when the ion files changed since it was packed"""
+    if not path.exists(path.join(ds_path, PACKED_IONS)):
+        return None
+    ions_df = pd.read_csv(path.join(ds_path, PACKED_IONS))
+    if not {'file', 'size', 'mtime_ns'} <= set(ions_df.columns):
+        return None
+    packed = tuple(sorted(zip(ions_df['file'], ions_df['size'], ions_df['mtime_ns'])))
+    return ions_df if packed == dataset_key(ds_path) else None
+
+
+def load_raw(ds_path):
+    """Ion images '<sf>_<adduct>.npy' of a dataset directory -> (ions, raw images as an (n_ions, H, W) array).
+    Images are memory-mapped and copied once into the stack, or the packed stack of the dataset is
+    memory-mapped as it is, read-only, when there is one and it is up to date with the ion files."""
+    ions_df = packed_ions(ds_path)
+    if ions_df is not None:
+        return list(zip(ions_df['sf'], ions_df['adduct'])), np.load(path.join(ds_path, PACKED_STACK), mmap_mode='r')
+    ions = []
+    images = []
+    for ion_file_name in ion_files(ds_path):
+        (sf, adduct) = ion_file_name.split('.')[0].split('_')
+        ions.append((sf, adduct))
+        images.append(np.load(path.join(ds_path, ion_file_name), mmap_mode='r'))
+    return ions, np.stack(images)
+
+
+def pack_dataset(ds_path):
+    """Write the raw images of a dataset as one array, memory-mapped by `load_raw` until an ion file changes.
+    An up to date pack is kept."""
+    if packed_ions(ds_path) is not None:
+        return
+    if path.exists(path.join(ds_path, PACKED_IONS)):
+        os.remove(path.join(ds_path, PACKED_IONS))
+    files = ion_files(ds_path)
+    stats = [os.stat(path.join(ds_path, f)) for f in files]
+    ions, images = load_raw(ds_path)
+    np.save(path.join(ds_path, PACKED_STACK), images)
+    # (name, size, modification time) of the ion files as packed, a pack of other files is ignored
+    ions_df = pd.DataFrame(ions, columns=['sf', 'adduct'])
+    ions_df['file'] = files
+    ions_df['size'] = [st.st_size for st in stats]
+    ions_df['mtime_ns'] = [st.st_mtime_ns for st in stats]
+    # ions are written last, so an interrupted pack is never loaded
+    ions_df.to_csv(path.join(ds_path, PACKED_IONS), index=False)
+
+
+def stack(images, mask=None):
+    """Images -> (n_ions, n_pixels) float32 matrix, only the pixels in `mask` when given"""
+    x = np.empty((len(images), images[0].size if mask is None else np.count_nonzero(mask)), dtype=np.float32)
+    for i, img in enumerate(images):
+        x[i] = img.ravel() if mask is None else img[mask]
+    return x
+
+
+def tissue_mask(images, method='union', tic_frac=MASK_TIC_FRAC):
+    """On-sample pixels of a dataset from its raw images: where any ion is detected ('union')
+    or where the total ion count is above `tic_frac` of its 99th percentile ('tic'), holes filled"""
+    if method == 'union':
+        mask = np.zeros(images[0].shape, dtype=bool)
+        for img in images:
+            mask |= img > 0
+    elif method == 'tic':
+        tic = np.zeros(images[0].shape)
+        for img in images:
+            tic += img
+        mask = tic > tic_frac * np.quantile(tic, 0.99)
+    else:
+        raise ValueError(f'Unknown mask method {method}, choose one of {MASK_METHODS}')
+    return ndimage.binary_fill_holes(mask)
+
+
+def dataset_mask(ds_path, method='union'):
+    """Tissue mask of a dataset, derived from the raw images once and stored in the dataset directory"""
+    mask_path = path.join(ds_path, MASK_FNAME.format(method))
+    if path.exists(mask_path):
+        return np.load(mask_path)
+    mask = tissue_mask(load_raw(ds_path)[1], method)
+    np.save(mask_path, mask)
+    return mask
+
+
+def mask_bbox(mask):
+    """(row slice, column slice) of the bounding box of a mask"""
+    rows, cols = np.flatnonzero(mask.any(axis=1)), np.flatnonzero(mask.any(axis=0))
+    if len(rows) == 0:
+        return slice(0, 0), slice(0, 0)
+    return slice(int(rows[0]), int(rows[-1]) + 1), slice(int(cols[0]), int(cols[-1]) + 1)
+
+
+def sparse_stack(x):
+    """Stacked images -> CSR matrix of the non-zero pixels"""
+    return sparse.csr_matrix(x)
+
+
+def _unit_rows(x):
+    """Rows scaled to unit norm, all-zero rows stay zero as in gensim; dense or CSR"""
+    if sparse.issparse(x):
+        norm = np.sqrt(np.asarray(x.multiply(x).sum(axis=1)).ravel())
+        return sparse.diags(1 / np.where(norm > 0, norm, 1)).astype(x.dtype) @ x
+    norm = np.linalg.norm(x, axis=1, keepdims=True)
+    return x / np.where(norm > 0, norm, 1)
+
+
+def _dot_rows(a, b):
+    """a @ b.T as a dense array, sparse products only touch non-zero pixels"""
+    r = a @ b.T
+    return r.toarray() if sparse.issparse(r) else r
+
+
+def cosine(x):
+    """All-pairs cosine similarity of the rows of `x`, dense or CSR"""
+    x = _unit_rows(x)
+    return _dot_rows(x, x)
+
+
+def pearson(x):
+    """All-pairs Pearson correlation of the rows of `x`, as pandas `DataFrame(x).T.corr()`,
+    NaN for constant rows"""
+    x = x - x.mean(axis=1, keepdims=True)
+    r = cosine(x)
+    constant = ~x.any(axis=1)
+    r[constant] = np.nan
+    r[:, constant] = np.nan
+    return r
+
+
+def spearman(x):
+    """All-pairs Spearman correlation of the rows of `x`, ties get average ranks"""
+    return pearson(rankdata(x, axis=1).astype(np.float32))
+
+
+def tfidf_cosine(x):
+    """gensim `TfidfModel` (idf = log2(n_ions / df), l2 normalized) of the ions, queried against the cosine index
+    of the raw intensities, as in the notebook: tfidf_cosine[i, j] = cos(tfidf(x[i]), x[j]); dense or CSR"""
+    if sparse.issparse(x):
+        x = x.tocsr()
+        x.eliminate_zeros()
+        df = np.bincount(x.indices, minlength=x.shape[1])
+    else:
+        df = np.count_nonzero(x, axis=0)
+    idf = np.log2(x.shape[0] / np.maximum(df, 1)).astype(np.float32)
+    tfidf = x @ sparse.diags(idf) if sparse.issparse(x) else x * idf
+    return _dot_rows(_unit_rows(tfidf), _unit_rows(x))
+
+
+def _gaussian(stack):
+    """Gaussian filter of each image of a (n, h, w) stack, as skimage.filters.gaussian of each image"""
+    return ndimage.gaussian_filter(stack, sigma=(0, SSIM_SIGMA, SSIM_SIGMA), mode='reflect', truncate=SSIM_TRUNCATE)
+
+
+_ssim_moments = None
+
+
+def _init_ssim(moments):
+    global _ssim_moments
+    _ssim_moments = moments
+
+
+def _ssim_pairs(pairs):
+    """SSIM of the image pairs (i, j), computed from the per-image moments and the filtered cross term"""
+    x, ux, vx, cov_norm, c1, c2, pad = _ssim_moments
+    i, j = pairs
+    uxy = _gaussian(x[i] * x[j])
+    uy = ux[j]
+    ux = ux[i]
+    vxy = cov_norm * (uxy - ux * uy)
+    a1, a2, b1, b2 = 2 * ux * uy + c1, 2 * vxy + c2, ux ** 2 + uy ** 2 + c1, vx[i] + vx[j] + c2
+    s = (a1 * a2) / (b1 * b2)
+    # per pair, so the float64 mean sums exactly as skimage does on a single image
+    return np.array([s_[pad: s_.shape[0] - pad, pad: s_.shape[1] - pad].mean(dtype=np.float64) for s_ in s])
+
+
+def ssim(images, processes=None, chunk_size=SSIM_CHUNK):
+    """All-pairs structural similarity with gaussian weights, data range of the image dtype,
+    equal to compare_ssim(gaussian_weights=True) of every pair.
+
+    The filtered mean and variance of each image are computed once, only the cross term
+    Gaussian(x * y) is filtered per pair, in chunks of pairs spread over `processes` processes."""
+    data_range = float(np.diff(dtype_range[images[0].dtype.type])[0])     # python float, keeps float32 images float32
+    float_type = np.float32 if images[0].dtype in (np.float16, np.float32) else np.float64
+    x = np.stack(images).astype(float_type, copy=False)
+    win_size = 2 * int(SSIM_TRUNCATE * SSIM_SIGMA + 0.5) + 1
+    cov_norm = win_size ** 2 / (win_size ** 2 - 1)   # sample covariance
+    ux = _gaussian(x)
+    vx = cov_norm * (_gaussian(x * x) - ux * ux)
+    moments = x, ux, vx, cov_norm, (SSIM_K1 * data_range) ** 2, (SSIM_K2 * data_range) ** 2, (win_size - 1) // 2
+
+    i, j = np.triu_indices(len(images), k=1)
+    chunks = [(i[k: k + chunk_size], j[k: k + chunk_size]) for k in range(0, len(i), chunk_size)]
+    processes = min(processes or os.cpu_count(), len(chunks))
+    if processes > 1:
+        ctx = mp.get_context('fork') if 'fork' in mp.get_all_start_methods() else mp.get_context()
+        with ctx.Pool(processes, initializer=_init_ssim, initargs=(moments,)) as pool:
+            values = pool.map(_ssim_pairs, chunks)
+    else:
+        _init_ssim(moments)
+        values = [_ssim_pairs(chunk) for chunk in chunks]
+
+    ssims = np.ones((len(images), len(images)))
+    if values:
+        ssims[i, j] = ssims[j, i] = np.concatenate(values)
+    return ssims
+
+
+def similarities(images, measures=MEASURES, sparse_density=SPARSE_DENSITY, processes=None, mask=None):
+    """{measure: (n_ions, n_ions) similarities} of preprocessed images, `processes` of ssim.
+    With a tissue `mask`, pixel measures only use the masked pixels and ssim the mask bounding box."""
+    x = stack(images, mask)
+    if mask is not None:
+        images = np.asarray(images)[(slice(None),) + mask_bbox(mask)]
+    xs = sparse_stack(x) if np.count_nonzero(x) <= sparse_density * x.size else x
+    measure_funs = {'cosine': lambda: cosine(xs), 'tfidf_cosine': lambda: tfidf_cosine(xs),
+                    'pearson': lambda: pearson(x), 'spearman': lambda: spearman(x),
+                    'ssim': lambda: ssim(images, processes)}
+    return {m: measure_funs[m]() for m in measures}
+
+
+def compute_similarities(ds_path, tfidf=TFIDF, sparse_density=SPARSE_DENSITY, cache=None, processes=None,
+                         mask=MASK, measures=MEASURES, **params):
+    """(ions, cosine, tfidf_cosine, pearson, spearman, ssims) of all ion pairs of a dataset,
+    similarities as (n_ions, n_ions) arrays; only `measures` are computed, the others are None,
+    so is `tfidf_cosine` without `tfidf`.
+    With a `StackCache`, similarities and preprocessed stacks are cached, keyed by the dataset files,
+    the parameters, the measures and the code version, so only what changed is recomputed. `processes` of ssim,
+    `mask` a tissue mask method of `dataset_mask`."""
+    measures = [m for m in MEASURES if m in measures and (tfidf or m != 'tfidf_cosine')]
+    if cache is not None:
+        key = cache.key('similarities', dataset_key(ds_path), preprocess_params(**params), tuple(measures), mask,
+                        CODE_VERSION)
+        sims = cache.get(key)
+        if sims is not None:
+            return sims
+    ions, images = load_dataset(ds_path, cache=cache, **params)
+    sims = similarities(images, measures, sparse_density, processes,
+                        dataset_mask(ds_path, mask) if mask is not None else None)
+    sims = (ions,) + tuple(sims.get(m) for m in MEASURES)
+    if cache is not None:
+        cache.put(key, sims)
+    return sims
+
+
+def gs_similarities(gs_df, img_dir, measures=MEASURES, tfidf=TFIDF, cache=None, **params):
+    """Similarities of the gold standard pairs, datasets in `img_dir/<datasetId>`, one column per measure,
+    no 'tfidf_cosine' column without `tfidf`"""
+    gs_df = gs_df.copy()
+    for datasetId, dsrows in gs_df.groupby('datasetId'):
+        print(datasetId)
+        ions, *sims = compute_similarities(path.join(img_dir, datasetId), tfidf=tfidf, cache=cache,
+                                           measures=measures, **params)
+        base_i, other_i = gs_pairs(ions, dsrows)
+        for m, sim in zip(MEASURES, sims):
+            if m in measures and sim is not None:
+                gs_df.loc[dsrows.index, m] = sim[base_i, other_i]
+    return gs_df
+
+
+def gs_pairs(ions, dsrows):
+    """Rows of the (base, other) ions of gold standard rows of one dataset in `ions`"""
+    ion_index = pd.MultiIndex.from_tuples(ions)
+    base_i = ion_index.get_indexer(pd.MultiIndex.from_frame(dsrows[['baseSf', 'baseAdduct']]))
+    other_i = ion_index.get_indexer(pd.MultiIndex.from_frame(dsrows[['otherSf', 'otherAdduct']]))
+    if (base_i < 0).any() or (other_i < 0).any():
+        raise ValueError(f'Dataset {dsrows["datasetId"].iloc[0]} misses gold standard ion images')
+    return base_i, other_i
+
+
+def evaluate(gs_df, measures=MEASURES):
+    """Mean Spearman and Kendall correlation of each measure with the reversed gold standard rank,
+    over (datasetId, baseSf, baseAdduct) sets"""
+    rev_rank = 10 - gs_df['rank']
+    results = []
+    for _, rows in gs_df.groupby(['datasetId', 'baseSf', 'baseAdduct']):
+        for m in measures:
+            results.append((m, spearmanr(rev_rank[rows.index], rows[m])[0],
+                            kendalltau(rev_rank[rows.index], rows[m])[0]))
+    return pd.DataFrame(results, columns=['measure', 'spearman', 'kendall']).groupby('measure', sort=True).mean()
@@ -0,0 +1,118 @@
+import os
+from os import path
+import argparse
+import queue
+import multiprocessing as mp
+import pandas as pd
+from coloc_measures import (MEASURES, TFIDF, QUAN, LOG, SQRT, HOTSPOT, MED_WIN, MASK, MASK_METHODS,
+                            ion_files, pack_dataset, compute_similarities, gs_pairs, evaluate)
+from stack_cache import StackCache
+
+
+# working set of a dataset in memory as a multiple of its image files: the raw stack, its float32 pixel
+# matrix, the ranks of spearman and the moments of ssim
+WORKING_SET_FACTOR = 6
+
+
+def _init_worker(args):
+    global _worker_args
+    _worker_args = args
+
+
+def _eval_dataset(datasetId):
+    """Measure columns of the GS rows of one dataset"""
+    gs_df, img_dir, measures, tfidf, cache, params = _worker_args
+    dsrows = gs_df[gs_df['datasetId'] == datasetId]
+    ions, *sims = compute_similarities(path.join(img_dir, datasetId), tfidf=tfidf, cache=cache, processes=1,
+                                       measures=measures, **params)
+    base_i, other_i = gs_pairs(ions, dsrows)
+    columns = {m: sim[base_i, other_i] for m, sim in zip(MEASURES, sims) if m in measures and sim is not None}
+    return pd.DataFrame(columns, index=dsrows.index)
+
+
+def dataset_size(ds_path):
+    return sum(os.path.getsize(path.join(ds_path, f)) for f in ion_files(ds_path))
+
+
+def working_set(ds_path):
+    """Estimated peak memory of evaluating a dataset"""
+    return WORKING_SET_FACTOR * dataset_size(ds_path)
+
+
+def gs_similarities_parallel(gs_df, img_dir, measures=MEASURES, tfidf=TFIDF, cache=None, processes=None,
+                             memory_budget=None, verbose=True, **params):
+    """`gs_similarities` with datasets fanned out over `processes` worker processes.
+
+    Images are memory-mapped (`coloc_measures.load_raw`). Datasets are scheduled largest first, a dataset
+    starts only while the estimated working sets (`working_set`) of the running ones fit in `memory_budget`
+    bytes, smaller datasets fill the gaps; one larger than the budget runs alone. A dataset that fails is
+    reported and skipped, its GS rows have no measure values. Measure columns of each dataset are merged
+    back into the GS frame."""
+    sizes = {d: working_set(path.join(img_dir, d)) for d in gs_df['datasetId'].unique()}
+    pending = sorted(sizes, key=lambda d: -sizes[d])
+    processes = min(processes or os.cpu_count(), len(pending))
+    ctx = mp.get_context('fork') if 'fork' in mp.get_all_start_methods() else mp.get_context()
+    args = gs_df, img_dir, measures, tfidf, cache, params
+
+    done = queue.Queue()
+    running, parts, failed = set(), [], []
+    with ctx.Pool(processes, initializer=_init_worker, initargs=(args,)) as pool:
+        while pending or running:
+            in_use = sum(sizes[d] for d in running)
+            for d in list(pending):
+                if len(running) == processes:
+                    break
+                if not running or memory_budget is None or in_use + sizes[d] <= memory_budget:
+                    pending.remove(d)
+                    running.add(d)
+                    in_use += sizes[d]
+                    pool.apply_async(_eval_dataset, (d,), callback=lambda rows, d=d: done.put((d, rows, None)),
+                                     error_callback=lambda e, d=d: done.put((d, None, e)))
+            d, rows, error = done.get()
+            running.remove(d)
+            if error is None:
+                parts.append(rows)
+            else:
+                failed.append(d)
+                print(f'Dataset {d} failed, skipped: {error!r}')
+            if verbose:
+                print(f'{len(parts) + len(failed)}/{len(sizes)} datasets')
+    if failed:
+        print(f'{len(failed)} datasets failed: {failed}')
+    return gs_df.join(pd.concat(parts)) if parts else gs_df.copy()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('gs_file', help='gold standard csv')
+    parser.add_argument('img_dir', help='gold standard images, one directory per dataset')
+    parser.add_argument('-output', default=None, help='csv file of the GS rows with measure columns')
+    parser.add_argument('-measures', nargs='+', default=MEASURES, choices=MEASURES)
+    parser.add_argument('-processes', type=int, default=None)
+    parser.add_argument('-memory_gb', type=float, default=None,
+                        help='memory budget of the datasets evaluated at a time, by estimated working set')
+    parser.add_argument('-cache_dir', default=None, help='disk cache of preprocessed stacks and similarities')
+    parser.add_argument('-pack', action='store_true', help='pack the images of every dataset into one array first')
+    parser.add_argument('-quan', type=float, default=QUAN)
+    parser.add_argument('-tfidf', type=int, default=int(TFIDF))
+    parser.add_argument('-log', type=int, default=int(LOG))
+    parser.add_argument('-sqrt', type=int, default=int(SQRT))
+    parser.add_argument('-hotspot', type=int, default=int(HOTSPOT))
+    parser.add_argument('-med_win', type=int, default=MED_WIN)
+    parser.add_argument('-mask', default=MASK, choices=MASK_METHODS, help='restrict measures to a tissue mask')
+    args = parser.parse_args()
+
+    gs_df = pd.read_csv(args.gs_file)
+    if args.pack:
+        for datasetId in gs_df['datasetId'].unique():
+            pack_dataset(path.join(args.img_dir, datasetId))
+    coloc_gs_df = gs_similarities_parallel(
+        gs_df, args.img_dir, args.measures, tfidf=bool(args.tfidf),
+        cache=StackCache(args.cache_dir) if args.cache_dir else None, processes=args.processes,
+        memory_budget=int(args.memory_gb * 2 ** 30) if args.memory_gb else None,
+        quan=args.quan, log=bool(args.log), sqrt=bool(args.sqrt), hotspot=bool(args.hotspot), med_win=args.med_win,
+        mask=args.mask)
+    if args.output is not None:
+        coloc_gs_df.to_csv(args.output, index=False)
+    for m, row in evaluate(coloc_gs_df, [m for m in args.measures if m in coloc_gs_df]).iterrows():
+        print('%s: spearman = %.3f, kendall = %.3f' % (m, row['spearman'], row['kendall']))
@@ -0,0 +1,104 @@
+import os
+from os import path
+import ast
+import argparse
+import multiprocessing as mp
+from itertools import product
+import pandas as pd
+from coloc_measures import (QUAN, TFIDF, LOG, SQRT, HOTSPOT, MED_WIN, MASK, MEASURES,
+                            load_raw, preprocess_stack, dataset_mask, similarities, gs_pairs, evaluate)
+
+
+PARAMS = ('quan', 'log', 'sqrt', 'hotspot', 'med_win', 'tfidf', 'mask')
+DEFAULTS = dict(quan=QUAN, log=LOG, sqrt=SQRT, hotspot=HOTSPOT, med_win=MED_WIN, tfidf=TFIDF, mask=MASK)
+
+
+def parse_value(v):
+    """Grid value from the command line, a python literal or a string, e.g. mask=None,union"""
+    try:
+        return ast.literal_eval(v)
+    except (ValueError, SyntaxError):
+        return v
+
+
+def param_grid(grid):
+    """{param: [values]} -> list of configurations {param: value}, other parameters at their defaults"""
+    unknown = set(grid) - set(PARAMS)
+    if unknown:
+        raise ValueError(f'Unknown parameters {sorted(unknown)}, choose from {PARAMS}')
+    names = list(grid)
+    return [dict(DEFAULTS, **dict(zip(names, values))) for values in product(*(grid[n] for n in names))]
+
+
+# raw images of the last dataset loaded by a worker, shared by the configurations of the dataset
+_raw = (None, None, None)
+
+
+def _init_sweep(img_dir, gs_df, measures):
+    global _sweep_args
+    _sweep_args = img_dir, gs_df, measures
+
+
+def _run_task(task):
+    """GS rows of one dataset and configuration -> (config index, {measure: values of the rows})"""
+    global _raw
+    datasetId, config_i, config = task
+    img_dir, gs_df, measures = _sweep_args
+    if _raw[0] != datasetId:
+        _raw = (datasetId, *load_raw(path.join(img_dir, datasetId)))
+    _, ions, raw = _raw
+    params = {p: v for p, v in config.items() if p not in ('tfidf', 'mask')}
+    images = preprocess_stack(raw, **params)
+    mask = dataset_mask(path.join(img_dir, datasetId), config['mask']) if config['mask'] is not None else None
+    dsrows = gs_df[gs_df['datasetId'] == datasetId]
+    base_i, other_i = gs_pairs(ions, dsrows)
+    ms = [m for m in measures if config['tfidf'] or m != 'tfidf_cosine']
+    sims = similarities(images, ms, processes=1, mask=mask)
+    return config_i, pd.DataFrame({m: sims[m][base_i, other_i] for m in ms}, index=dsrows.index)
+
+
+def sweep(gs_df, img_dir, configs, measures=MEASURES, processes=None, verbose=True):
+    """Mean Spearman / Kendall correlation with the gold standard of each measure and configuration,
+    a tidy table with one row per (configuration, measure).
+
+    (dataset, configuration) tasks run on a process pool, dataset-major, the configurations of a dataset
+    in one chunk, so raw images are loaded once per dataset and reused by all configurations."""
+    datasetIds = sorted(gs_df['datasetId'].unique())
+    tasks = [(datasetId, i, config) for datasetId in datasetIds for i, config in enumerate(configs)]
+    processes = min(processes or os.cpu_count(), len(datasetIds))
+    ctx = mp.get_context('fork') if 'fork' in mp.get_all_start_methods() else mp.get_context()
+
+    config_rows = [[] for _ in configs]
+    with ctx.Pool(processes, initializer=_init_sweep, initargs=(img_dir, gs_df, measures)) as pool:
+        for n, (config_i, rows) in enumerate(pool.imap_unordered(_run_task, tasks, chunksize=len(configs))):
+            config_rows[config_i].append(rows)
+            if verbose and (n + 1) % len(configs) == 0:
+                print(f'{(n + 1) // len(configs)}/{len(datasetIds)} datasets')
+
+    results = []
+    for config, rows in zip(configs, config_rows):
+        config_df = gs_df.join(pd.concat(rows))
+        ms = [m for m in measures if config['tfidf'] or m != 'tfidf_cosine']
+        for m, row in evaluate(config_df, ms).iterrows():
+            results.append(dict(config, measure=m, spearman=row['spearman'], kendall=row['kendall']))
+    return pd.DataFrame(results, columns=list(PARAMS) + ['measure', 'spearman', 'kendall'])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('gs_file', help='gold standard csv')
+    parser.add_argument('img_dir', help='gold standard images, one directory per dataset')
+    parser.add_argument('output', help='csv file of the results table')
+    parser.add_argument('-grid', nargs='+', default=[], metavar='PARAM=V1,V2',
+                        help=f'parameter values to sweep, e.g. quan=0,0.5 med_win=0,3; parameters: {PARAMS}')
+    parser.add_argument('-measures', nargs='+', default=MEASURES, choices=MEASURES)
+    parser.add_argument('-processes', type=int, default=None)
+    args = parser.parse_args()
+
+    grid = {}
+    for arg in args.grid:
+        name, values = arg.split('=', 1)
+        grid[name] = [parse_value(v) for v in values.split(',')]
+    results = sweep(pd.read_csv(args.gs_file), args.img_dir, param_grid(grid), args.measures, args.processes)
+    results.to_csv(args.output, index=False)
+    print(results.sort_values('spearman', ascending=False).head(10))
@@ -0,0 +1,98 @@
+import os
+import hashlib
+import pickle
+from pathlib import Path
+
+
+MAX_BYTES = 10 * 2 ** 30    # cache size budget
+EXT = 'pkl'
+
+
+def source_key(paths):
+    """Identity of source files: (name, size, modification time) of each file, in name order"""
+    stats = [(Path(p).name, os.stat(p)) for p in paths]
+    return tuple(sorted((name, st.st_size, st.st_mtime_ns) for name, st in stats))
+
+
+def code_version(source_path):
+    """Hash of a module source, cached results are invalidated by any change of the code"""
+    return hashlib.sha1(Path(source_path).read_bytes()).hexdigest()[:12]
+
+
+class StackCache(object):
+    """Disk cache of preprocessed image stacks and similarity matrices.
+
+    Entries are pickles in `cache_dir`, content addressed: named by the hash of their key,
+    e.g. (source files, preprocessing parameters, code version), so a changed parameter or file is a new entry.
+    Reads refresh the file modification time, and the least recently used entries are deleted
+    when the cache exceeds `max_bytes`.
+    """
+
+    def __init__(self, cache_dir, max_bytes=MAX_BYTES):
+        self.cache_dir = Path(cache_dir)
+        self.max_bytes = max_bytes
+        Path.mkdir(self.cache_dir, parents=True, exist_ok=True)
+
+    @staticmethod
+    def key(*parts):
+        return hashlib.sha1(repr(parts).encode()).hexdigest()
+
+    def _path(self, key):
+        return self.cache_dir / f'{key}.{EXT}'
+
+    def __contains__(self, key):
+        return self._path(key).exists()
+
+    def get(self, key, default=None):
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                value = pickle.load(f)
+        except FileNotFoundError:
+            return default
+        os.utime(path)
+        return value
+
+    def put(self, key, value):
+        path = self._path(key)
+        tmp_path = path.with_name(f'{path.name}.{os.getpid()}.tmp')
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+        # atomic, concurrent readers see the old entry or the complete new one
+        os.replace(tmp_path, path)
+        self.evict(keep=path)
+
+    def get_or_compute(self, key, fun):
+        value = self.get(key)
+        if value is None:
+            value = fun()
+            self.put(key, value)
+        return value
+
+    def size(self):
+        return sum(p.stat().st_size for p in self.cache_dir.glob(f'*.{EXT}'))
+
+    def evict(self, keep=None):
+        """Delete least recently used entries until the cache fits in `max_bytes`, never `keep`"""
+        entries = []
+        for p in self.cache_dir.glob(f'*.{EXT}'):
+            try:
+                st = p.stat()
+            except FileNotFoundError:   # evicted by another process
+                continue
+            entries.append((st.st_mtime_ns, st.st_size, p))
+        total = sum(size for _, size, _ in entries)
+        for _, size, p in sorted(entries, key=lambda e: e[0]):
+            if total <= self.max_bytes:
+                break
+            if p == keep:
+                continue
+            try:
+                p.unlink()
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def clear(self):
+        for p in self.cache_dir.glob(f'*.{EXT}'):
+            p.unlink()
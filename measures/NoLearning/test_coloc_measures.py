@@ -0,0 +1,28 @@
+import numpy as np
+import pytest
+from skimage.metrics import structural_similarity
+
+from coloc_measures import ssim
+
+
+def _images(dtype, n=6, shape=(40, 50)):
+    rng = np.random.RandomState(0)
+    images = rng.rand(n, *shape) * (rng.rand(n, *shape) < 0.3)
+    images[1] = images[0] * 0.5 + images[1] * 0.5
+    return list(images.astype(dtype))
+
+
+@pytest.mark.parametrize('dtype, tol', [(np.float64, 1e-10), (np.float32, 1e-5)])
+@pytest.mark.parametrize('processes, chunk_size', [(1, 64), (1, 4), (2, 4)])
+def test_ssim_matches_skimage(dtype, tol, processes, chunk_size):
+    images = _images(dtype)
+    ssims = ssim(images, processes=processes, chunk_size=chunk_size)
+
+    n = len(images)
+    expected = np.ones((n, n))
+    for i in range(n):
+        for j in range(i + 1, n):
+            # float images have the dtype range (-1, 1), as coloc_measures.ssim uses
+            expected[i, j] = expected[j, i] = structural_similarity(
+                images[i], images[j], gaussian_weights=True, data_range=2.)
+    assert np.allclose(ssims, expected, rtol=0, atol=tol)
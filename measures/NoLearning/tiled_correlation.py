@@ -0,0 +1,98 @@
+from os import path
+import argparse
+import numpy as np
+import pandas as pd
+from coloc_measures import QUAN, MED_WIN, preprocess, ion_files
+
+
+MAX_BYTES = 2 * 2 ** 30     # working memory, besides the memory-mapped input and output
+
+
+def write_stack(ds_path, out_path, **params):
+    """Preprocessed ion images of a dataset -> (n_ions, n_pixels) float32 .npy, one image in memory at a time.
+    Returns the ions."""
+    files = sorted(ion_files(ds_path))
+    ions = [tuple(f.split('.')[0].split('_')) for f in files]
+    first = np.load(path.join(ds_path, files[0]), mmap_mode='r')
+    x = np.lib.format.open_memmap(out_path, mode='w+', dtype=np.float32, shape=(len(files), first.size))
+    for i, f in enumerate(files):
+        x[i] = preprocess(np.array(np.load(path.join(ds_path, f), mmap_mode='r')), **params).ravel()
+    x.flush()
+    return ions
+
+
+def _block_sizes(n, max_bytes):
+    """Rows of the result and pixel columns held in memory at a time: half of `max_bytes` for the
+    row_block x n float64 accumulator and product buffer, the rest for the n x tile float64 tile"""
+    row_block = int(min(n, max(1, max_bytes // 2 // (8 * 2 * n))))
+    tile = int(max(1, (max_bytes - 8 * 2 * row_block * n) // (8 * n)))
+    return row_block, tile
+
+
+def tiled_correlation(x, out=None, center=True, max_bytes=MAX_BYTES):
+    """All-pairs Pearson correlation (cosine similarity without `center`) of the rows of an (n, n_pixels) matrix,
+    typically memory-mapped, as coloc_measures.pearson / cosine, with bounded memory.
+
+    Pixel-column tiles of `x` are streamed, first for the row sums, then for the centered sums of products
+    of a block of result rows against all rows, written to `out` (e.g. a memory-mapped .npy) block by block.
+    The accumulator, product buffer and tile are preallocated and sized to take at most `max_bytes`
+    together (`_block_sizes`); when the n x n accumulator doesn't fit, `x` is streamed once per row block."""
+    n, n_pixels = x.shape
+    if out is None:
+        out = np.empty((n, n), dtype=np.float32)
+    row_block, tile = _block_sizes(n, max_bytes)
+    tile_buf = np.empty((n, min(tile, n_pixels)))
+    sxy_buf = np.empty((row_block, n))
+    prod_buf = np.empty((row_block, n))
+
+    # tiles and results are centered and scaled row by row, broadcasting ufuncs would allocate buffers
+    mean, tile_sum = np.zeros(n), np.empty(n)
+    if center:
+        for c in range(0, n_pixels, tile):
+            t = tile_buf[:, : min(tile, n_pixels - c)]
+            np.copyto(t, x[:, c: c + tile])
+            mean += np.add.reduce(t, axis=1, out=tile_sum)
+        mean /= n_pixels
+
+    norm = np.zeros(n)
+    for r in range(0, n, row_block):
+        rows = slice(r, min(r + row_block, n))
+        sxy, prod = sxy_buf[: rows.stop - r], prod_buf[: rows.stop - r]
+        sxy[...] = 0
+        for c in range(0, n_pixels, tile):
+            t = tile_buf[:, : min(tile, n_pixels - c)]
+            np.copyto(t, x[:, c: c + tile])
+            if center:
+                for i in range(n):
+                    t[i] -= mean[i]
+            np.matmul(t[rows], t.T, out=prod)
+            sxy += prod
+            if r == 0:
+                norm += np.einsum('ij,ij->i', t, t)
+        if r == 0:
+            norm = np.sqrt(norm)
+            # constant rows: NaN correlations as pearson, zero rows: zero cosines as cosine
+            inv_norm = np.where(norm > 0, 1 / np.where(norm > 0, norm, 1), np.nan if center else 0)
+        for i in range(rows.stop - r):
+            sxy[i] *= inv_norm[r + i] * inv_norm
+            out[r + i] = sxy[i]
+    return out
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('ds_path', help='dataset directory of <sf>_<adduct>.npy ion images')
+    parser.add_argument('output', help='.npy file of the (n_ions, n_ions) correlations, ions are saved as .csv beside')
+    parser.add_argument('-cosine', action='store_true', help='cosine similarity instead of Pearson correlation')
+    parser.add_argument('-max_gb', type=float, default=MAX_BYTES / 2 ** 30, help='working memory')
+    parser.add_argument('-quan', type=float, default=QUAN)
+    parser.add_argument('-med_win', type=int, default=MED_WIN)
+    args = parser.parse_args()
+
+    stack_path = path.splitext(args.output)[0] + '.stack.npy'
+    ions = write_stack(args.ds_path, stack_path, quan=args.quan, med_win=args.med_win)
+    x = np.load(stack_path, mmap_mode='r')
+    out = np.lib.format.open_memmap(args.output, mode='w+', dtype=np.float32, shape=(len(x), len(x)))
+    tiled_correlation(x, out, center=not args.cosine, max_bytes=int(args.max_gb * 2 ** 30))
+    out.flush()
+    pd.DataFrame(ions, columns=['sf', 'adduct']).to_csv(path.splitext(args.output)[0] + '.csv', index=False)